@@ -0,0 +1,92 @@
+# Swagger spec built once per worker, or once at build time.
+#
+#   python apispec.py [DIRECTORY]
+#
+# writes the spec of every flasgger endpoint to DIRECTORY/<endpoint>.json
+# (APISPEC_DIR by default). A worker started with APISPEC_DIR pointing at
+# those files serves them as static files and never parses the route
+# docstrings. Rebuild them whenever a route or its docstring changes.
+
+import json
+import os
+import sys
+import threading
+
+from flask import send_file
+from flasgger import Swagger
+
+
+class LazySwagger(Swagger):
+    """
+    Swagger parsing the route docstrings on the first request for a spec
+    only, then answering from memory. Endpoints with a file in `spec_dir`
+    are served from it instead.
+    """
+
+    def __init__(self, *args, spec_dir=None, **kwargs):
+        self.spec_dir = spec_dir
+        self._specs = {}
+        self._specs_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app, decorators=None):
+        super().init_app(app, decorators)
+
+        if not self.spec_dir:
+            return
+
+        blueprint = self.config.get('endpoint', 'flasgger')
+        for spec in self.config['specs']:
+            path = self.spec_path(spec['endpoint'])
+            if os.path.exists(path):
+                app.view_functions['%s.%s' % (blueprint, spec['endpoint'])] = self._static_view(path)
+
+    def spec_path(self, endpoint):
+        return os.path.join(self.spec_dir, endpoint + '.json')
+
+    def get_apispecs(self, endpoint='apispec_1'):
+        spec = self._specs.get(endpoint)
+        if spec is None:
+            with self._specs_lock:
+                spec = self._specs.get(endpoint)
+                if spec is None:
+                    spec = super().get_apispecs(endpoint)
+                    self._specs[endpoint] = spec
+        return spec
+
+    def build(self, app, directory):
+        """Write the spec of every endpoint to `directory`, returns the paths written."""
+
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+
+        with app.test_request_context():
+            for spec in self.config['specs']:
+                path = os.path.join(directory, spec['endpoint'] + '.json')
+                with open(path, 'w') as f:
+                    json.dump(super().get_apispecs(spec['endpoint']), f, separators=(',', ':'), default=str)
+                paths.append(path)
+
+        return paths
+
+    def _static_view(self, path):
+        def view():
+            return send_file(path, mimetype='application/json', conditional=True)
+        return view
+
+
+def main():
+    import app as module
+
+    app = module.create_app()
+    swagger = module.swagger
+    directory = sys.argv[1] if len(sys.argv) > 1 else swagger.spec_dir
+    if not directory:
+        sys.exit('usage: apispec.py DIRECTORY, or set APISPEC_DIR')
+
+    for path in swagger.build(app, directory):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
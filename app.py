@@ -1,13 +1,49 @@
-from flask import Flask, jsonify, request
+import time
+
+# Taken before any other import, see metrics.BootTimes
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, Response, jsonify, make_response, request, send_file, g
+import functools
+import json
+import logging
 import os
-import mysql.connector
+import threading
 from flask_cors import CORS
 from datetime import timedelta
-from flasgger import Swagger
+
+from apispec import LazySwagger
+from cache import ReferenceCache
+from compression import Compressor
+from db import ConnectionPool, PoolTimeout, ReplicaSet
+from events import EventHub
+from images import ImageStore
+from mirror import Mirror
+from permissions import PermissionIndex
+from writebehind import QueueFull, WriteBehindQueue
+import ingest
+import metrics
+import pagination
+import purge
+import repository
+import rollups
+import schema
+import statements
+import streaming
+import versions
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Encoding time of every JSON body is added to the request's metrics
+app.json = metrics.TimedJSONProvider(app)
+
 CORS(app)
-Swagger(app)
+# The spec is built on the first /apispec_1.json request, or served from the
+# files written by `python apispec.py` into APISPEC_DIR
+swagger = LazySwagger(app, spec_dir=os.environ.get('APISPEC_DIR') or None)
+
+boot_times = metrics.BootTimes(BOOT_STARTED)
 
 # db_config = {
 #     'user': 'yohann',
@@ -17,13 +53,546 @@ Swagger(app)
 #     'database': 'objura_bdd'
 # }
 
+# DB_HOST, DB_PORT, DB_USER and DB_NAME point the app at another server, e.g. a local benchmark database
 db_config = {
-    'user': 'u743632769_yohann',
+    'user': os.environ.get('DB_USER', 'u743632769_yohann'),
     'password': os.environ.get('DB_PASSWORD'),
-    'host': 'clementyziquel.fr',
-    'port': 3306,
-    'database': 'u743632769_objura_bdd'
+    'host': os.environ.get('DB_HOST', 'clementyziquel.fr'),
+    'port': int(os.environ.get('DB_PORT', 3306)),
+    'database': os.environ.get('DB_NAME', 'u743632769_objura_bdd')
 }
+# The pure Python driver uses the socket module, which gevent workers patch.
+# Only passed when set, the driver otherwise falls back to it by itself when
+# its C extension is not installed
+if os.environ.get('DB_USE_PURE'):
+    db_config['use_pure'] = os.environ['DB_USE_PURE'] == '1'
+
+# Largest batch accepted by create_disparitions
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 5000))
+
+# One pool per gunicorn worker, connections are only opened on first use
+pool = ConnectionPool(
+    db_config,
+    size=int(os.environ.get('DB_POOL_SIZE', 5)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    recycle=float(os.environ.get('DB_POOL_RECYCLE', 3600)),
+    pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    wrap=metrics.InstrumentedConnection
+)
+
+# Read replicas as DB_REPLICAS=host[:port],..., with the credentials and database
+# of db_config. GET requests read from the least loaded healthy replica
+replicas = ReplicaSet(
+    pool,
+    [
+        ConnectionPool(
+            dict(db_config, host=host, port=int(port or db_config['port'])),
+            size=int(os.environ.get('DB_POOL_SIZE', 5)),
+            timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            recycle=float(os.environ.get('DB_POOL_RECYCLE', 3600)),
+            pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+            wrap=metrics.InstrumentedConnection
+        )
+        for host, _, port in (
+            replica.strip().partition(':') for replica in os.environ.get('DB_REPLICAS', '').split(',') if replica.strip()
+        )
+    ],
+    max_lag=float(os.environ.get('DB_REPLICA_MAX_LAG', 10)),
+    check_interval=float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+)
+
+# Reads of a client stay on the primary for this many seconds after it wrote,
+# so it sees its own changes whatever the replication lag
+STICKY_SECONDS = float(os.environ.get('DB_STICKY_SECONDS', 5))
+STICKY_COOKIE = 'db_primary_until'
+
+# Names of houses, rooms and cameras, write routes must invalidate what they change
+reference_cache = ReferenceCache(
+    maxsize=int(os.environ.get('REFCACHE_SIZE', 4096)),
+    ttl=float(os.environ.get('REFCACHE_TTL', 300))
+)
+
+# can_consult grants by user, answered from memory. Reloaded when the
+# can_consult, house or user counters moved, checked every
+# PERMISSION_INDEX_CHECK_INTERVAL seconds, and in any case after
+# PERMISSION_INDEX_TTL seconds or a rebuild
+permission_index = PermissionIndex(
+    ttl=float(os.environ.get('PERMISSION_INDEX_TTL', 300)),
+    check_interval=float(os.environ.get('PERMISSION_INDEX_CHECK_INTERVAL', 5))
+)
+
+# Local copy of house, room, camera, can_consult and user answering their
+# routes from memory, reads fall back to MySQL once it is older than
+# MIRROR_MAX_STALENESS seconds
+mirror = None
+if os.environ.get('MIRROR_ENABLED', '0') == '1':
+    mirror = Mirror(
+        pool,
+        refresh_interval=float(os.environ.get('MIRROR_REFRESH_INTERVAL', 30)),
+        max_staleness=float(os.environ.get('MIRROR_MAX_STALENESS', 120))
+    )
+
+# New disparitions pushed to the clients of get_disparitions_stream
+event_hub = EventHub(
+    pool,
+    encode=lambda data: app.json.dumps(data, separators=(',', ':')),
+    buffer_size=int(os.environ.get('EVENTS_BUFFER_SIZE', 100)),
+    history_size=int(os.environ.get('EVENTS_HISTORY_SIZE', 200)),
+    poll_interval=float(os.environ.get('EVENTS_POLL_INTERVAL', 2.0))
+)
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+
+# A stream holds a server thread for as long as its client stays connected,
+# the Flask route serves at most EVENTS_MAX_STREAMS of them per worker so
+# the other routes keep threads. SERVER_MODE=async serves streams natively
+# on the event loop, without this cap
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 2))
+stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+# In async mode create_disparition answers 202 and a background thread writes the batch
+DISPARITION_WRITE_MODE = os.environ.get('DISPARITION_WRITE_MODE', 'sync')
+
+write_behind = WriteBehindQueue(
+    pool,
+    maxsize=int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 1000)),
+    batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100)),
+    interval=float(os.environ.get('WRITE_BEHIND_INTERVAL', 1.0)),
+    on_insert=event_hub.publish_created
+)
+
+# Images sent to create_disparition are written here and only their URL is
+# kept in disparition_image_overview. The store is local to the server, a
+# deployment with several hosts points IMAGE_STORE_DIR at a shared volume.
+# Images no disparition uses any more are removed by the deletions, unless
+# stored or reused in the last IMAGE_REMOVE_GRACE seconds
+IMAGE_REMOVE_GRACE = float(os.environ.get('IMAGE_REMOVE_GRACE', 300))
+image_store = ImageStore(os.environ.get('IMAGE_STORE_DIR', os.path.join(app.instance_path, 'images')),
+                         grace=IMAGE_REMOVE_GRACE)
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 31536000))
+
+
+# Hook of every deletion: the rollups are uncounted and the images left
+# without a disparition removed
+def on_delete(cursor, rows):
+    rollups.on_delete(cursor, rows)
+    return image_store.on_delete(cursor, rows)
+
+
+# Seconds slept between the delete batches of delete_disparitions and retention
+PURGE_PAUSE = float(os.environ.get('PURGE_PAUSE', 0))
+
+# Disparitions older than RETENTION_DAYS are deleted in the background,
+# RETENTION_HOUSE_DAYS=house_id=days,... sets the period of single houses.
+# Tombstones are kept TOMBSTONE_RETENTION_DAYS, RETENTION_DAYS by default: a
+# delta client offline for longer has to resync
+retention = purge.RetentionJob(
+    pool,
+    days=int(os.environ.get('RETENTION_DAYS', 0)),
+    overrides=purge.parse_retention(os.environ.get('RETENTION_HOUSE_DAYS', '')),
+    interval=float(os.environ.get('RETENTION_INTERVAL', 3600)),
+    pause=PURGE_PAUSE,
+    on_delete=on_delete,
+    tombstone_days=int(os.environ.get('TOMBSTONE_RETENTION_DAYS', os.environ.get('RETENTION_DAYS', 0)))
+)
+
+# Responses below COMPRESSION_MIN_SIZE bytes are sent as is
+compressor = Compressor(
+    min_size=int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+    level=int(os.environ.get('COMPRESSION_LEVEL', 6)),
+    cache_size=int(os.environ.get('COMPRESSION_CACHE_SIZE', 64)),
+    cache_ttl=float(os.environ.get('COMPRESSION_CACHE_TTL', 60))
+)
+
+# Per-route histograms served on /metrics, a request running more than
+# QUERY_BUDGET queries is logged as a warning (0 disables the check)
+metrics_registry = metrics.Registry(
+    query_budget=int(os.environ.get('QUERY_BUDGET', 20))
+)
+
+# Application factory, called by gunicorn (see gunicorn.conf.py), asgi.py
+# and `python app.py`. Importing the module already gives a complete app,
+# `gunicorn app:app` and `flask run` included, whose routes and per-worker
+# resources open no connection and start no thread before they are used.
+# With preload_app the factory runs in the gunicorn master, PRELOAD_WARM=1
+# then loads the mirror and the API spec there, once, so every worker
+# shares them copy-on-write
+warmed = False
+
+def create_app():
+    global warmed
+
+    if warmed:
+        return app
+    warmed = True
+
+    if os.environ.get('PRELOAD_WARM', '0') == '1':
+        with app.test_request_context():
+            swagger.get_apispecs()
+        if mirror is not None:
+            mirror.refresh()
+            # Closed before any fork, workers open their own
+            pool.close_all()
+
+    return app
+
+# Called in every worker right after gunicorn forked it: connections and
+# background threads inherited from a preloaded master are dropped, the
+# worker opens its own on first use, and the retention job is started
+def post_fork():
+    pool.after_fork()
+    replicas.after_fork()
+    statements.after_fork()
+    if mirror is not None:
+        mirror.after_fork()
+    event_hub.after_fork()
+    write_behind.after_fork()
+    retention.after_fork()
+    retention.start()
+
+# Reads go to a replica unless the client wrote within the sticky window
+def reads_from_replica():
+    if request.method not in ('GET', 'HEAD') or not replicas.replicas:
+        return False
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) < time.time()
+    except ValueError:
+        return True
+
+# Borrow a connection from the pool for the rest of the request
+def get_db():
+    if 'db' not in g:
+        start = time.perf_counter()
+        if reads_from_replica():
+            # The API tables are created on the primary, replicas receive them
+            if not schema.ready():
+                with pool.connection() as conn:
+                    schema.ensure(conn)
+            g.db_pool, g.db = replicas.acquire_read()
+        else:
+            g.db_pool, g.db = pool, pool.acquire()
+        request_metrics = metrics.current()
+        if request_metrics is not None:
+            request_metrics.pool_wait += time.perf_counter() - start
+    return g.db
+
+# Give the connection back to the pool when the request is done
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool').release(conn)
+
+# A successful write pins the client's reads to the primary for a while
+@app.after_request
+def stick_to_primary(response):
+    if replicas.replicas and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        response.set_cookie(
+            STICKY_COOKIE, '%.3f' % (time.time() + STICKY_SECONDS),
+            max_age=int(STICKY_SECONDS) + 1, httponly=True, samesite='Lax'
+        )
+    return response
+
+@app.before_request
+def start_request_metrics():
+    boot_times.mark_first_request()
+    g.request_metrics = metrics.RequestMetrics()
+
+# Background jobs start with the first request so they run in the worker,
+# post_fork() starts them earlier under gunicorn
+@app.before_request
+def start_retention():
+    retention.start()
+
+# Streamed responses are torn down once their body is sent, so their
+# histograms include the queries run while streaming
+@app.teardown_request
+def record_request_metrics(exception):
+    request_metrics = g.pop('request_metrics', None)
+    if request_metrics is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics_registry.observe(route, request_metrics)
+
+@app.errorhandler(pagination.InvalidPageArgs)
+@app.errorhandler(repository.InvalidFields)
+@app.errorhandler(repository.InvalidSnapshotArgs)
+@app.errorhandler(rollups.InvalidStatisticsArgs)
+def handle_invalid_args(error):
+    return jsonify({
+        'status': str(error)
+    }), 400
+
+# Paginated list responses carry the cursor of the next page, None on the last one
+def page_response(items, next_key):
+    return jsonify({
+        'items': items,
+        'next_cursor': pagination.encode_cursor(next_key) if next_key is not None else None
+    })
+
+# Conditional GET backed by version counters: `scopes` maps the view arguments
+# to the counters the response depends on, a matching If-None-Match is
+# answered with a 304 before the view runs its query
+def versioned(scopes):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            view_scopes = scopes(**kwargs)
+            # Versions of the mirrored rows when the view is answered from the mirror
+            numbers = mirror.versions(view_scopes) if mirror is not None else None
+            if numbers is None:
+                numbers = versions.read(get_db(), view_scopes)
+            # Without a change signal every request runs the view
+            if numbers is None:
+                return view(*args, **kwargs)
+            etag = versions.make_etag(numbers, view_scopes, request.full_path)
+            # Compressed bodies are cached for this exact path, never by ETag alone
+            g.compression_key = versions.cache_key(numbers, view_scopes, request.full_path)
+
+            for variant in compressor.etag_variants(etag):
+                if request.if_none_match.contains(variant):
+                    response = app.response_class(status=304)
+                    response.set_etag(variant)
+                    return response
+
+            # Same version already compressed for this encoding, skip the query.
+            # Only reached with an ETag made of maintained counters
+            body, encoding = compressor.cached(g.compression_key)
+            if body is not None:
+                response = app.response_class(body, mimetype=app.json.mimetype)
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                response.set_etag('%s-%s' % (etag, encoding))
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+# Compress responses the client accepts gzip or brotli for
+@app.after_request
+def compress_response(response):
+    return compressor.process(response, g.get('compression_key'))
+
+# Registered after compress_response so it runs first, the header of a
+# streamed response only covers what happened before the body is sent
+@app.after_request
+def add_server_timing(response):
+    request_metrics = metrics.current()
+    if request_metrics is not None:
+        request_metrics.status = response.status_code
+        response.headers['Server-Timing'] = request_metrics.server_timing()
+        # CORS is open to every origin, so are the timings
+        response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(error):
+    return jsonify({
+        'status': 'Database busy, try again later'
+    }), 503
+
+# Route to get runtime statistics of this worker
+@app.route('/api/v1/stats', methods=['GET'])
+def get_stats():
+    """
+    Get runtime statistics of the worker
+
+    This endpoint returns the connection pool, cache and index statistics of the worker serving the request.
+
+    ---
+    responses:
+      200:
+        description: Worker statistics
+        schema:
+          type: object
+          properties:
+            pool:
+              type: object
+              properties:
+                size:
+                  type: integer
+                in_use:
+                  type: integer
+                idle:
+                  type: integer
+                wait_time_avg:
+                  type: number
+                wait_time_max:
+                  type: number
+            reference_cache:
+              type: object
+              description: Hit and miss counters of the house, room and camera name caches
+            permission_index:
+              type: object
+              description: Size, age and hit counters of the can_consult index
+            write_behind:
+              type: object
+              description: Queue depth and counters of the create_disparition write-behind queue
+            statements:
+              type: object
+              description: Prepare and execution counters of the prepared statement registry
+            compression:
+              type: object
+              description: Settings and cache counters of response compression
+            events:
+              type: object
+              description: Subscribers and counters of the disparition event hub
+            mirror:
+              type: object
+              description: Age, row counts and hit counters of the local table mirror, null when disabled
+            replicas:
+              type: object
+              description: Health, lag and read counters of the read replicas
+            retention:
+              type: object
+              description: Settings and counters of the background retention job
+            boot:
+              type: object
+              description: Seconds the worker took to import the app and to get its first request
+    """
+
+    return jsonify({
+        'pid': os.getpid(),
+        'pool': pool.stats(),
+        'reference_cache': reference_cache.stats(),
+        'permission_index': permission_index.stats(),
+        'write_behind': write_behind.stats(),
+        'statements': statements.stats(),
+        'compression': compressor.stats(),
+        'events': event_hub.stats(),
+        'mirror': mirror.stats() if mirror is not None else None,
+        'replicas': replicas.stats(),
+        'retention': retention.stats(),
+        'boot': boot_times.stats()
+    })
+
+# Route to scrape the request metrics of this worker
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Get the metrics of the worker in the Prometheus text format
+
+    This endpoint returns per-route histograms of request duration, database time, pool wait time, serialisation time, query count and rows fetched, followed by pool, cache and queue gauges. Every worker only reports the requests it served, samples are labelled with its pid.
+
+    ---
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Metrics in the Prometheus text exposition format
+    """
+
+    pool_stats = pool.stats()
+    index_stats = permission_index.stats()
+    compression_stats = compressor.stats()
+    statement_stats = statements.stats()
+    queue_stats = write_behind.stats()
+    boot_stats = boot_times.stats()
+    index_lookups = index_stats['hits'] + index_stats['misses']
+
+    mirror_ratio = []
+    if mirror is not None:
+        mirror_stats = mirror.stats()
+        mirror_lookups = mirror_stats['hits'] + mirror_stats['fallbacks']
+        mirror_ratio.append(
+            ({'cache': 'mirror'}, round(mirror_stats['hits'] / mirror_lookups, 4) if mirror_lookups else 0.0)
+        )
+
+    gauges = [
+        ('pool_connections', 'Connections of the pool by state', [
+            ({'state': 'in_use'}, pool_stats['in_use']),
+            ({'state': 'idle'}, pool_stats['idle'])
+        ]),
+        ('pool_checkouts', 'Connections checked out of the pool', [({}, pool_stats['checkouts'])]),
+        ('pool_timeouts', 'Checkouts that gave up waiting for a connection', [({}, pool_stats['timeouts'])]),
+        ('pool_wait_seconds', 'Time spent waiting for a connection', [
+            ({'stat': 'total'}, pool_stats['wait_time_total']),
+            ({'stat': 'max'}, pool_stats['wait_time_max'])
+        ]),
+        ('cache_hit_ratio', 'Hit ratio of the in-process caches', [
+            ({'cache': 'reference_' + table}, table_stats['hit_ratio'])
+            for table, table_stats in sorted(reference_cache.stats().items())
+        ] + [
+            ({'cache': 'permission_index'}, round(index_stats['hits'] / index_lookups, 4) if index_lookups else 0.0),
+            ({'cache': 'compression'}, compression_stats['hit_ratio'])
+        ] + mirror_ratio),
+        ('prepared_statements', 'Prepared statement registry counters', [
+            ({'stat': name}, statement_stats[name]) for name in ('prepares', 'executions', 'reprepares')
+        ]),
+        ('write_behind_queued', 'Disparitions waiting in the write-behind queue', [({}, queue_stats['queued'])]),
+        ('boot_seconds', 'Seconds from the start of the app import', [
+            ({'stage': stage}, seconds) for stage, seconds in (
+                ('imported', boot_stats['import_seconds']),
+                ('first_request', boot_stats['first_request_seconds'])
+            ) if seconds is not None
+        ]),
+    ]
+
+    return Response(metrics_registry.render(os.getpid(), gauges), mimetype='text/plain; version=0.0.4')
+
+# Route to rebuild the can_consult index
+@app.route('/api/v1/rebuild_permissions', methods=['POST'])
+def rebuild_permissions():
+    """
+    Rebuild the consult permissions index
+
+    This endpoint reloads the can_consult index of the worker serving the request. Other workers pick the change up when their index expires.
+
+    ---
+    responses:
+      200:
+        description: Index rebuilt successfully
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Status message
+            permission_index:
+              type: object
+    """
+
+    permission_index.rebuild(get_db)
+    if mirror is not None:
+        mirror.invalidate()
+
+    return jsonify({
+        'status': 'Permission index rebuilt successfully',
+        'permission_index': permission_index.stats()
+    })
+
+# Route to recount the disparition statistics
+@app.route('/api/v1/rebuild_statistics', methods=['POST'])
+def rebuild_statistics():
+    """
+    Rebuild the disparition statistics
+
+    This endpoint recounts the daily statistics of every house from the disparition table. The statistics are kept up to date by the API, this is only needed for disparitions written to the database directly.
+
+    ---
+    responses:
+      200:
+        description: Statistics rebuilt successfully
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Status message
+    """
+
+    conn = get_db()
+    rollups.rebuild(conn)
+
+    cursor = conn.cursor()
+    versions.bump(cursor, ['disparition'])
+    conn.commit()
+    cursor.close()
+
+    return jsonify({
+        'status': 'Statistics rebuilt successfully'
+    })
 
 # Route to get all users
 @app.route('/api/v1/get_users', methods=['GET'])
@@ -34,6 +603,22 @@ def get_users():
     This endpoint returns a list of all users in the system.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated fields to return, the other columns are not selected
     responses:
       200:
         description: A list of users
@@ -51,28 +636,25 @@ def get_users():
               user_password:
                 type: string
     """
-    
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT * FROM user')
-    results = cursor.fetchall()
+    fields = repository.parse_fields('users', request.args.get('fields'))
+    conn = get_db()
 
-    cursor.close()
-    conn.close()
+    if pagination.requested():
+        cursor = conn.cursor()
 
-    data = []
+        limit, after = pagination.page_args(1)
+        items, next_key = repository.page_users(cursor, limit, after, fields)
 
-    for row in results:
-        person_data = {
-            'user_email': row[0],
-            'user_firstname': row[1],
-            'user_lastname': row[2],
-            'user_password': row[3]
-        }
-        data.append(person_data)
+        cursor.close()
 
-    return jsonify(data)
+        return page_response(items, next_key)
+
+    if fields is not None:
+        sql, formatter = repository.list_query('users', fields)
+        return streaming.stream_json_array(conn, sql, (), formatter)
+
+    return streaming.stream_json_array(conn, repository.USERS_SQL, (), repository.user_row)
 
 # Route to create a user
 @app.route('/api/v1/create_user', methods=['POST'])
@@ -106,7 +688,7 @@ def create_user():
               description: Status message
     """
     
-    conn = mysql.connector.connect(**db_config)
+    conn = get_db()
     cursor = conn.cursor()
 
     email = request.json['email']
@@ -116,7 +698,9 @@ def create_user():
     conn.commit()
 
     cursor.close()
-    conn.close()
+
+    if mirror is not None:
+        mirror.invalidate()
 
     return jsonify({
         'status': 'User created successfully'
@@ -124,6 +708,7 @@ def create_user():
 
 # Route to get houses
 @app.route('/api/v1/get_houses', methods=['GET'])
+@versioned(lambda: ['house'])
 def get_houses():
     """
     Get a list of all houses
@@ -131,6 +716,22 @@ def get_houses():
     This endpoint returns a list of all houses in the system.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated fields to return, the other columns are not selected
     responses:
       200:
         description: A list of houses
@@ -143,30 +744,56 @@ def get_houses():
                 type: integer
               house_name:
                 type: string
+      304:
+        description: Not modified since the ETag sent in If-None-Match
     """
-    
-    conn = mysql.connector.connect(**db_config)
+
+    fields = repository.parse_fields('houses', request.args.get('fields'))
+
+    # The mirror holds whole rows, a projection is selected from MySQL
+    if mirror is not None and fields is None:
+        if pagination.requested():
+            limit, after = pagination.page_args(1)
+            page = mirror.page_houses(limit, after)
+            if page is not None:
+                return page_response(*page)
+        else:
+            data = mirror.houses()
+            if data is not None:
+                return jsonify(data)
+
+    conn = get_db()
     cursor = conn.cursor()
 
+    if pagination.requested():
+        limit, after = pagination.page_args(1)
+        items, next_key = repository.page_houses(cursor, limit, after, fields)
+
+        cursor.close()
+
+        return page_response(items, next_key)
+
+    if fields is not None:
+        sql, formatter = repository.list_query('houses', fields)
+        cursor.execute(sql)
+        data = [formatter(row) for row in cursor.fetchall()]
+
+        cursor.close()
+
+        return jsonify(data)
+
     cursor.execute('SELECT * FROM house')
     results = cursor.fetchall()
 
     cursor.close()
-    conn.close()
 
-    data = []
-
-    for row in results:
-        house_data = {
-            'house_id': row[0],
-            'house_name': row[1]
-        }
-        data.append(house_data)
+    data = [repository.house_row(row) for row in results]
 
     return jsonify(data)
 
 # Route to get rooms
 @app.route('/api/v1/get_rooms', methods=['GET'])
+@versioned(lambda: ['room'])
 def get_rooms():
     """
     Get a list of all rooms
@@ -174,6 +801,22 @@ def get_rooms():
     This endpoint returns a list of all rooms in the system.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated fields to return, the other columns are not selected
     responses:
       200:
         description: A list of rooms
@@ -191,26 +834,50 @@ def get_rooms():
               house_id:
                 type: integer
                 description: The ID of the house to which the room belongs
+      304:
+        description: Not modified since the ETag sent in If-None-Match
     """
 
-    conn = mysql.connector.connect(**db_config)
+    fields = repository.parse_fields('rooms', request.args.get('fields'))
+
+    # The mirror holds whole rows, a projection is selected from MySQL
+    if mirror is not None and fields is None:
+        if pagination.requested():
+            limit, after = pagination.page_args(1)
+            page = mirror.page_rooms(limit, after)
+            if page is not None:
+                return page_response(*page)
+        else:
+            data = mirror.rooms()
+            if data is not None:
+                return jsonify(data)
+
+    conn = get_db()
     cursor = conn.cursor()
 
+    if pagination.requested():
+        limit, after = pagination.page_args(1)
+        items, next_key = repository.page_rooms(cursor, limit, after, fields)
+
+        cursor.close()
+
+        return page_response(items, next_key)
+
+    if fields is not None:
+        sql, formatter = repository.list_query('rooms', fields)
+        cursor.execute(sql)
+        data = [formatter(row) for row in cursor.fetchall()]
+
+        cursor.close()
+
+        return jsonify(data)
+
     cursor.execute('SELECT * FROM room')
     results = cursor.fetchall()
 
     cursor.close()
-    conn.close()
 
-    data = []
-
-    for row in results:
-        room_data = {
-            'room_id': row[0],
-            'room_name': row[1],
-            'house_id': row[2]
-        }
-        data.append(room_data)
+    data = [repository.room_with_house_row(row) for row in results]
 
     return jsonify(data)
 
@@ -223,6 +890,17 @@ def get_videos():
     This endpoint returns a list of all videos in the system.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
     responses:
       200:
         description: A list of videos
@@ -239,26 +917,19 @@ def get_videos():
                 type: integer
     """
 
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
+    conn = get_db()
 
-    cursor.execute('SELECT * FROM video')
-    results = cursor.fetchall()
+    if pagination.requested():
+        cursor = conn.cursor()
 
-    cursor.close()
-    conn.close()
+        limit, after = pagination.page_args(1)
+        items, next_key = repository.page_videos(cursor, limit, after)
 
-    response_data = []
+        cursor.close()
 
-    for row in results:
-        video_data = {
-            'video_id': row[0],
-            'video_name': row[1],
-            'room_id': row[2]
-        }
-        response_data.append(video_data)
+        return page_response(items, next_key)
 
-    return jsonify(response_data)
+    return streaming.stream_json_array(conn, repository.VIDEOS_SELECT, (), repository.video_row)
 
 # Route to get can consult
 @app.route('/api/v1/get_canconsult', methods=['GET'])
@@ -269,6 +940,22 @@ def get_can_consult():
     This endpoint returns a list of all consult permissions in the system. It includes details about the user and the house they can consult.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated fields to return, the other columns are not selected
     responses:
       200:
         description: A list of consult permissions
@@ -288,41 +975,42 @@ def get_can_consult():
               house_name:
                 type: string
     """
-    
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
 
-    cursor.execute('SELECT * FROM can_consult')
-    results = cursor.fetchall()
 
-    response_data = []
+    fields = repository.parse_fields('can_consult', request.args.get('fields'))
 
-    for row in results:
-        user_id = row[0]
-        house_id = row[1]
-
-        # Get user_firstname and user_lastname with user_ida
-        cursor.execute('SELECT user_firstname, user_lastname FROM user WHERE user_id = %s', (user_id,))
-        user_results = cursor.fetchall()
-        user_firstname = user_results[0][0]
-        user_lastname = user_results[0][1]
-
-        # Get house_name with house_id
-        cursor.execute('SELECT house_name FROM house WHERE house_id = %s', (house_id,))
-        house_results = cursor.fetchall()
-        house_name = house_results[0][0]
-
-        can_consult_data = {
-            'user_id': user_id,
-            'user_firstname': user_firstname,
-            'user_lastname': user_lastname,
-            'house_id': house_id,
-            'house_name': house_name
-        }
-        response_data.append(can_consult_data)
-    
-    cursor.close()
-    conn.close()
+    # The mirror and the permission index hold whole rows, a projection is selected from MySQL
+    if fields is not None:
+        conn = get_db()
+        cursor = conn.cursor()
+
+        if pagination.requested():
+            limit, after = pagination.page_args(2)
+            items, next_key = repository.page_can_consult(cursor, limit, after, fields)
+
+            cursor.close()
+
+            return page_response(items, next_key)
+
+        sql, formatter = repository.list_query('can_consult', fields)
+        cursor.execute(sql)
+        data = [formatter(row) for row in cursor.fetchall()]
+
+        cursor.close()
+
+        return jsonify(data)
+
+    if pagination.requested():
+        limit, after = pagination.page_args(2)
+        page = mirror.page_can_consult(limit, after) if mirror is not None else None
+        if page is None:
+            page = permission_index.page_can_consult(get_db, limit, after)
+
+        return page_response(*page)
+
+    response_data = mirror.can_consult() if mirror is not None else None
+    if response_data is None:
+        response_data = permission_index.can_consult(get_db)
 
     return jsonify(response_data)
 
@@ -355,29 +1043,10 @@ def get_houses_of_a_user(user_id):
                 type: string
     """
     
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT house_id FROM can_consult WHERE user_id = %s', (user_id,))
-    results = cursor.fetchall()
 
-    data = []
-
-    for row in results:
-        house_id = row[0]
-
-        cursor.execute('SELECT house_name FROM house WHERE house_id = %s', (house_id,))
-        house_results = cursor.fetchall()
-        house_name = house_results[0][0]
-
-        house_data = {
-            'house_id': house_id,
-            'house_name': house_name
-        }
-        data.append(house_data)
-    
-    cursor.close()
-    conn.close()
+    data = mirror.houses_of_user(user_id) if mirror is not None else None
+    if data is None:
+        data = permission_index.houses_of_user(get_db, user_id)
 
     return jsonify(data)
 
@@ -409,34 +1078,16 @@ def get_rooms_of_a_house(house_id):
                 type: string
     """
     
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT room_id FROM room WHERE house_id = %s', (house_id,))
-    results = cursor.fetchall()
-
-    data = []
-
-    for row in results:
-        room_id = row[0]
-
-        cursor.execute('SELECT room_name FROM room WHERE room_id = %s', (room_id,))
-        room_results = cursor.fetchall()
-        room_name = room_results[0][0]
-
-        room_data = {
-            'room_id': room_id,
-            'room_name': room_name
-        }
-        data.append(room_data)
-    
-    cursor.close()
-    conn.close()
+    data = mirror.rooms_of_house(house_id) if mirror is not None else None
+    if data is None:
+        conn = get_db()
+        data = [repository.room_row(row) for row in statements.run(conn, 'rooms_of_house', (house_id,))]
 
     return jsonify(data)
 
 # Route to get cameras of a house
 @app.route('/api/v1/get_cameras/<house_id>', methods=['GET'])
+@versioned(lambda house_id: ['camera'])
 def get_cameras_of_a_house(house_id):
     """
     Get a list of cameras in a specific house
@@ -461,38 +1112,21 @@ def get_cameras_of_a_house(house_id):
                 type: integer
               camera_name:
                 type: string
+      304:
+        description: Not modified since the ETag sent in If-None-Match
     """
     
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT camera_id FROM camera WHERE house_id = %s', (house_id,))
-    results = cursor.fetchall()
-
-    data = []
-
-    for row in results:
-        camera_id = row[0]
-
-        cursor.execute('SELECT camera_name FROM camera WHERE camera_id = %s', (camera_id,))
-        camera_results = cursor.fetchall()
-        camera_name = camera_results[0][0]
-
-        camera_data = {
-            'camera_id': camera_id,
-            'camera_name': camera_name
-        }
-        data.append(camera_data)
-    
-    cursor.close()
-    conn.close()
+    data = mirror.cameras_of_house(house_id) if mirror is not None else None
+    if data is None:
+        conn = get_db()
+        data = [repository.camera_row(row) for row in statements.run(conn, 'cameras_of_house', (house_id,))]
 
     return jsonify(data)
 
 # Route to get disparitions history of a house_id with date, hour, room_name, object and image_overview
 @app.route('/api/v1/get_disparitions_history/<house_id>', methods=['GET'])
 def get_disparitions_history_of_a_house(house_id):
-    conn = mysql.connector.connect(**db_config)
+    conn = get_db()
     cursor = conn.cursor()
 
     cursor.execute('SELECT * FROM room WHERE house_id = %s', (house_id,))
@@ -514,7 +1148,6 @@ def get_disparitions_history_of_a_house(house_id):
         data.append(disparition_data)
 
     cursor.close()
-    conn.close()
 
     return jsonify(data)
 
@@ -570,37 +1203,14 @@ def get_videos_of_a_room_of_a_house(house_id, room_id):
                     type: string
     """
     
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT house_name FROM house WHERE house_id = %s', (house_id,))
-    house_results = cursor.fetchall()
-    house_name = house_results[0][0]
+    conn = get_db()
 
-    cursor.execute('SELECT room_name FROM room WHERE room_id = %s', (room_id,))
-    room_results = cursor.fetchall()
-    room_name = room_results[0][0]
+    house_name = reference_cache.name(conn, 'house', house_id)
+    room_name = reference_cache.name(conn, 'room', room_id)
 
-    cursor.execute('SELECT * FROM video WHERE room_id = %s', (room_id,))
-    video_results = cursor.fetchall()
+    video_results = statements.run(conn, 'videos_of_room', (room_id,))
 
-    data = []
-
-    for row in video_results:
-        video_id = row[0]
-        video_date = str(row[1])  # Convertir timedelta en chaîne
-        video_length = str(row[2])  # Convertir timedelta en chaîne
-        video_object_stolen = row[3]
-        video_link = row[4]
-
-        video_data = {
-            'video_id': video_id,
-            'video_date': video_date,
-            'video_length': video_length,
-            'video_object_stolen': video_object_stolen,
-            'video_link': video_link
-        }
-        data.append(video_data)
+    data = [repository.room_video_row(row) for row in video_results]
 
     response_data = {
         'house_id': house_id,
@@ -610,15 +1220,99 @@ def get_videos_of_a_room_of_a_house(house_id, room_id):
         'videos': data
     }
 
+    return jsonify(response_data)
+
+# Route to get a house with its rooms, cameras, videos and recent disparitions in one request
+@app.route('/api/v1/get_house_snapshot/<house_id>', methods=['GET'])
+@versioned(lambda house_id: ['house', 'room', 'camera', 'disparition', 'disparition:' + house_id])
+def get_house_snapshot(house_id):
+    """
+    Get a snapshot of a house
+
+    This endpoint returns a house with the relations listed in include nested in it, replacing the calls to get_rooms, get_cameras, get_videos of every room and get_disparitions. Each relation is fetched with one query for the whole house.
+
+    ---
+    parameters:
+      - name: house_id
+        in: path
+        type: integer
+        required: true
+      - name: include
+        in: query
+        type: string
+        required: false
+        description: Comma separated relations among rooms, cameras, videos and recent_disparitions, all of them by default. videos are nested in the rooms
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Number of recent disparitions, 10 by default
+
+    responses:
+      200:
+        description: The house and its relations
+        schema:
+          type: object
+          properties:
+            house_id:
+              type: integer
+            house_name:
+              type: string
+            rooms:
+              type: array
+              items:
+                type: object
+                properties:
+                  room_id:
+                    type: integer
+                  room_name:
+                    type: string
+                  videos:
+                    type: array
+                    items:
+                      type: object
+            cameras:
+              type: array
+              items:
+                type: object
+                properties:
+                  camera_id:
+                    type: integer
+                  camera_name:
+                    type: string
+            recent_disparitions:
+              type: array
+              items:
+                type: object
+      304:
+        description: Not modified since the ETag sent in If-None-Match
+      400:
+        description: Unknown relation in include or invalid limit
+      404:
+        description: Unknown house
+    """
+
+    include, limit = repository.snapshot_args(request.args)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    snapshot = repository.house_snapshot(cursor, house_id, include, limit)
+
     cursor.close()
-    conn.close()
 
-    return jsonify(response_data)
+    if snapshot is None:
+        return jsonify({
+            'status': 'House not found'
+        }), 404
+
+    return jsonify(snapshot)
 
 # Route to get videos of a house
 # Return json with disparition_id, disparition_date, disparition_object_stolen, disparition_image_overview, 
 # room_id, camera_id, video_id, video_date, video_length, video_link, camera_name, room_name, house_id, house_name
 @app.route('/api/v1/get_disparitions/<house_id>', methods=['GET'])
+@versioned(lambda house_id: ['room', 'camera', 'disparition', 'disparition:' + house_id])
 def get_disparitions_of_a_house(house_id):
     """
     Get a list of disparitions in a specific house
@@ -631,6 +1325,21 @@ def get_disparitions_of_a_house(house_id):
         in: path
         type: integer
         required: true
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, enables paginated output
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated fields to return, e.g. without disparition_image_overview for list views
 
     responses:
       200:
@@ -648,6 +1357,7 @@ def get_disparitions_of_a_house(house_id):
                 type: boolean
               disparition_image_overview:
                 type: string
+                description: Inline image data, or the get_image URL of images stored out of the row
               disparition_object:
                 type: string
               camera_id:
@@ -666,62 +1376,318 @@ def get_disparitions_of_a_house(house_id):
                 type: string
               video_link:
                 type: string
+      304:
+        description: Not modified since the ETag sent in If-None-Match
     """
-    
-    conn = mysql.connector.connect(**db_config)
+
+    fields = repository.parse_fields('disparitions', request.args.get('fields'))
+    conn = get_db()
+
+    if pagination.requested():
+        cursor = conn.cursor()
+
+        limit, after = pagination.page_args(2)
+        items, next_key = repository.page_disparitions_of_house(cursor, house_id, limit, after, fields)
+
+        cursor.close()
+
+        return page_response(items, next_key)
+
+    if fields is not None:
+        sql, formatter = repository.list_query(
+            'disparitions', fields, conditions=['r.house_id = %s'], order_by=('d.disparition_id',)
+        )
+        return streaming.stream_json_array(conn, sql, (house_id,), formatter)
+
+    return streaming.stream_json_array(conn, repository.DISPARITIONS_OF_HOUSE_SQL, (house_id,), repository.disparition_row)
+
+# Route to get the disparitions of a house created or deleted since a watermark
+@app.route('/api/v1/get_disparitions_delta/<house_id>', methods=['GET'])
+@versioned(lambda house_id: ['room', 'camera', 'disparition', 'disparition:' + house_id])
+def get_disparitions_delta_of_a_house(house_id):
+    """
+    Get the changes to the disparitions of a house since a watermark
+
+    This endpoint returns the disparitions created and the ids of the disparitions deleted since the watermark of a previous call, so that a client can keep a local copy in sync. Without watermark it starts from the beginning of the history. Deletions are only kept for TOMBSTONE_RETENTION_DAYS, a watermark older than that is answered with 410 and the client has to reload its copy with get_disparitions.
+
+    ---
+    parameters:
+      - name: house_id
+        in: path
+        type: integer
+        required: true
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: Watermark returned by the previous call
+      - name: since_id
+        in: query
+        type: integer
+        required: false
+        description: Last disparition_id already known, to start from a get_disparitions copy
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Maximum number of created and of deleted disparitions returned
+
+    responses:
+      200:
+        description: Changes since the watermark
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              description: Created disparitions, same fields as get_disparitions
+              items:
+                type: object
+            deleted:
+              type: array
+              items:
+                type: integer
+            watermark:
+              type: string
+            has_more:
+              type: boolean
+      304:
+        description: Not modified since the ETag sent in If-None-Match
+      410:
+        description: Deletions after the watermark were pruned, resync required
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+            resync_required:
+              type: boolean
+    """
+
+    try:
+        limit = int(request.args.get('limit', pagination.DEFAULT_LIMIT))
+        since_id = int(request.args.get('since_id', 0))
+    except ValueError:
+        raise pagination.InvalidPageArgs('limit and since_id must be integers')
+
+    if limit < 1 or limit > pagination.MAX_LIMIT:
+        raise pagination.InvalidPageArgs('limit must be between 1 and %d' % pagination.MAX_LIMIT)
+
+    watermark = pagination.decode_cursor(request.args['since'], 2) if request.args.get('since') else None
+    if watermark is not None and not all(isinstance(part, int) for part in watermark):
+        raise pagination.InvalidPageArgs('Invalid cursor')
+
+    conn = get_db()
+    schema.ensure(conn)
     cursor = conn.cursor()
+    pruned = versions.pruned_tombstone(cursor)
+
+    if watermark is not None:
+        last_disparition, last_tombstone = watermark
+        # Deletions after the watermark may be gone, a delta would miss them
+        if last_tombstone < pruned:
+            cursor.close()
+            return jsonify({
+                'status': 'Watermark too old, reload the disparitions with get_disparitions',
+                'resync_required': True
+            }), 410
+    else:
+        # A copy from get_disparitions has none of the pruned deletions
+        last_disparition, last_tombstone = since_id, pruned
+
+    items, last_disparition, more_items = repository.disparitions_since(cursor, house_id, last_disparition, limit)
+    deleted, last_tombstone, more_deleted = repository.tombstones_since(cursor, house_id, last_tombstone, limit)
 
-    request = 'SELECT * FROM disparition WHERE room_id IN (SELECT room_id FROM room WHERE house_id = %s)'
+    cursor.close()
 
-    cursor.execute(request, (house_id,))
-    disparition_results = cursor.fetchall()
+    return jsonify({
+        'items': items,
+        'deleted': deleted,
+        'watermark': pagination.encode_cursor((last_disparition, last_tombstone)),
+        'has_more': more_items or more_deleted
+    })
 
-    data = []
+# Route to get disparition counts of a house per time bucket, for charts
+@app.route('/api/v1/get_statistics/<house_id>', methods=['GET'])
+@versioned(lambda house_id: ['room', 'disparition', 'disparition:' + house_id])
+def get_statistics_of_a_house(house_id):
+    """
+    Get disparition counts of a house
 
-    for row in disparition_results:
-        disparition_id = row[0]
-        disparition_date = str(row[1])
-        disparition_object_stolen = row[2]
-        disparition_image_overview = row[3]
-        disparition_object = row[4]
-        camera_id = row[5]
-        room_id = row[6]
+    This endpoint returns the number of disparitions of a house per day, week, month or year, optionally split by room, object or stolen flag. Counts are read from daily aggregates, so the cost depends on the number of buckets and not on the number of disparitions.
 
-        cursor.execute('SELECT room_name FROM room WHERE room_id = %s', (room_id,))
-        room_results = cursor.fetchall()
-        room_name = room_results[0][0]
+    ---
+    parameters:
+      - name: house_id
+        in: path
+        type: integer
+        required: true
+      - name: bucket
+        in: query
+        type: string
+        enum: [day, week, month, year, all]
+        default: day
+        required: false
+      - name: group_by
+        in: query
+        type: string
+        enum: [none, room, object, stolen]
+        default: none
+        required: false
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: First day counted, ISO date
+      - name: until
+        in: query
+        type: string
+        required: false
+        description: Day after the last one counted, ISO date
+    responses:
+      200:
+        description: Counts per bucket, in bucket then group order
+        schema:
+          type: object
+          properties:
+            house_id:
+              type: integer
+            bucket:
+              type: string
+            group_by:
+              type: string
+            total:
+              type: integer
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  bucket:
+                    type: string
+                    description: First day of the bucket, null when bucket is all
+                  room_id:
+                    type: integer
+                  room_name:
+                    type: string
+                  disparition_object:
+                    type: string
+                  disparition_object_stolen:
+                    type: integer
+                  count:
+                    type: integer
+      304:
+        description: Not modified since the ETag sent in If-None-Match
+      400:
+        description: Unsupported bucket or group_by, or invalid date
+    """
 
-        cursor.execute('SELECT camera_name FROM camera WHERE camera_id = %s', (camera_id,))
-        camera_results = cursor.fetchall()
-        camera_name = camera_results[0][0]
-        
-        cursor.execute('SELECT video_id, video_date, video_length, video_link FROM video WHERE disparition_id = %s', (disparition_id,))
-        video_results = cursor.fetchall()
-        video_id = video_results[0][0]
-        video_date = str(video_results[0][1])
-        video_length = str(video_results[0][2])
-        video_link = video_results[0][3]
-
-        data.append({
-            'disparition_id': disparition_id,
-            'disparition_date': disparition_date,
-            'disparition_object_stolen': disparition_object_stolen,
-            'disparition_image_overview': disparition_image_overview,
-            'disparition_object': disparition_object,
-            'camera_id': camera_id,
-            'room_id': room_id,
-            'room_name': room_name,
-            'camera_name': camera_name,
-            'video_id': video_id,
-            'video_date': video_date,
-            'video_length': video_length,
-            'video_link': video_link,
-        })
+    bucket = request.args.get('bucket', 'day')
+    group_by = request.args.get('group_by', 'none')
+
+    try:
+        since = purge.parse_date(request.args.get('since'))
+        until = purge.parse_date(request.args.get('until'))
+    except ValueError as error:
+        return jsonify({
+            'status': str(error)
+        }), 400
+
+    conn = get_db()
+    schema.ensure(conn)
+    cursor = conn.cursor()
+
+    cursor.execute(*rollups.statistics_query(house_id, bucket, group_by, since, until))
+    items = [rollups.statistics_row(group_by, row) for row in cursor.fetchall()]
 
     cursor.close()
-    conn.close()
 
-    return jsonify(data)
+    return jsonify({
+        'house_id': house_id,
+        'bucket': bucket,
+        'group_by': group_by,
+        'total': sum(item['count'] for item in items),
+        'items': items
+    })
+
+# Route to receive the new disparitions of a house as Server-Sent Events
+@app.route('/api/v1/get_disparitions_stream/<house_id>', methods=['GET'])
+def get_disparitions_stream_of_a_house(house_id):
+    """
+    Receive the new disparitions of a house as they are created
+
+    This endpoint keeps the connection open and sends every disparition created in the house as a Server-Sent Event whose id is the disparition_id and whose data has the fields of get_disparitions. A comment is sent as heartbeat when nothing happens. Reconnecting clients send Last-Event-ID to receive what they missed. A client that falls too far behind receives a dropped event and is disconnected.
+
+    ---
+    produces:
+      - text/event-stream
+    parameters:
+      - name: house_id
+        in: path
+        type: integer
+        required: true
+      - name: Last-Event-ID
+        in: header
+        type: integer
+        required: false
+
+    responses:
+      200:
+        description: Stream of disparition events
+      503:
+        description: This worker already serves EVENTS_MAX_STREAMS streams, retry later
+    """
+
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({
+            'status': 'Too many event streams, try again later'
+        }), 503, {'Retry-After': '5'}
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    # The connection goes back to the pool when the view returns, not when the stream ends
+    try:
+        subscription = event_hub.subscribe(get_db(), house_id, last_event_id)
+    except Exception:
+        stream_slots.release()
+        raise
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscription.get(EVENTS_HEARTBEAT)
+                if event is not None:
+                    yield 'id: %d\nevent: disparition\ndata: %s\n\n' % event
+                elif subscription.dropped:
+                    yield 'event: dropped\ndata: {}\n\n'
+                    break
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Called by the server once the stream is over, whether or not it started
+    response.call_on_close(stream_slots.release)
+
+    return response
+
+# Push inserted (disparition_id, video_id) pairs to the stream subscribers. The
+# rows are committed by then, a failure is logged rather than turned into an
+# error the client would retry into a duplicate
+def publish_created(conn, ids):
+    try:
+        event_hub.publish_created(conn, [disparition_id for disparition_id, video_id in ids])
+    except Exception as error:
+        logger.warning('Publishing created disparitions failed: %s', error)
 
 # Route to create a disparition
 @app.route('/api/v1/create_disparition', methods=['POST'])
@@ -745,6 +1711,7 @@ def create_disparition():
               type: integer
             disparition_image_overview:
               type: string
+              description: Base64 image or data URL, stored out of the row and replaced by its get_image URL
             disparition_object:
               type: string
             camera_id:
@@ -767,45 +1734,286 @@ def create_disparition():
             status:
               type: string
               description: Status message
+      202:
+        description: Disparition queued, returned when DISPARITION_WRITE_MODE is async
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+            tracking_id:
+              type: string
+      400:
+        description: Missing fields in the body
+      503:
+        description: The ingestion queue is full, retry later
     """
     
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
+    try:
+        record = ingest.parse_record(request.get_json(silent=True), image_store)
+    except ingest.InvalidRecord as error:
+        return jsonify({
+            'status': str(error)
+        }), 400
+
+    if DISPARITION_WRITE_MODE == 'async':
+        try:
+            tracking_id = write_behind.submit(record)
+        except QueueFull as error:
+            return jsonify({
+                'status': str(error)
+            }), 503, {'Retry-After': '1'}
+
+        return jsonify({
+            'status': 'Disparition queued',
+            'tracking_id': tracking_id
+        }), 202, {'Location': '/api/v1/disparition_status/' + tracking_id}
+
+    conn = get_db()
+    ids = ingest.insert_disparitions(conn, [record])
+    publish_created(conn, ids)
 
-    disparition_date = request.json['disparition_date']
-    disparition_object_stolen = request.json['disparition_object_stolen']
-    disparition_image_overview = request.json['disparition_image_overview']
-    disparition_object = request.json['disparition_object']
-    camera_id = request.json['camera_id']
-    room_id = request.json['room_id']
-    video_date = request.json['video_date']
-    video_length = request.json['video_length']
-    video_link = request.json['video_link']
-
-    cursor.execute('INSERT INTO disparition (disparition_date, disparition_object_stolen, disparition_image_overview, disparition_object, camera_id, room_id) VALUES (%s, %s, %s, %s, %s, %s)', (disparition_date, disparition_object_stolen, disparition_image_overview, disparition_object, camera_id, room_id))
-    conn.commit()
+    return jsonify({
+        'status': 'Disparition created successfully'
+    })
 
-    cursor.execute('INSERT INTO video (video_date, video_length, video_link, disparition_id) VALUES (%s, %s, %s, %s)', (video_date, video_length, video_link, cursor.lastrowid))
-    conn.commit()
+# Route to get an image stored by create_disparition
+@app.route('/api/v1/get_image/<digest>', methods=['GET'])
+def get_image(digest):
+    """
+    Get a disparition image
 
-    cursor.close()
-    conn.close()
+    This endpoint returns an image stored by create_disparition. Images are named by the SHA-256 of their content, so a response never changes and can be cached for good. Range requests are supported.
+
+    ---
+    parameters:
+      - name: digest
+        in: path
+        type: string
+        required: true
+        description: SHA-256 of the image, as found in disparition_image_overview
+      - name: Range
+        in: header
+        type: string
+        required: false
+
+    responses:
+      200:
+        description: The image
+      206:
+        description: The requested range of the image
+      304:
+        description: Not modified since the ETag sent in If-None-Match
+      404:
+        description: Unknown image
+    """
+
+    path = image_store.path(digest)
+    if path is None or not os.path.exists(path):
+        return jsonify({
+            'status': 'Image not found'
+        }), 404
+
+    response = send_file(
+        path, mimetype=image_store.mimetype(path), conditional=True, etag=digest, max_age=IMAGE_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+# Route to follow a disparition queued by create_disparition
+@app.route('/api/v1/disparition_status/<tracking_id>', methods=['GET'])
+def get_disparition_status(tracking_id):
+    """
+    Get the status of a queued disparition
+
+    This endpoint returns the state of a disparition accepted with a 202 by create_disparition. Statuses are kept by the worker that accepted the disparition.
+
+    ---
+    parameters:
+      - name: tracking_id
+        in: path
+        type: string
+        required: true
+
+    responses:
+      200:
+        description: Status of the disparition
+        schema:
+          type: object
+          properties:
+            tracking_id:
+              type: string
+            state:
+              type: string
+              enum: [queued, created, failed]
+            disparition_id:
+              type: integer
+            video_id:
+              type: integer
+            error:
+              type: string
+      404:
+        description: Unknown tracking id
+    """
+
+    status = write_behind.status(tracking_id)
+    if status is None:
+        return jsonify({
+            'status': 'Unknown tracking id'
+        }), 404
+
+    return jsonify(status)
+
+# Route to create several disparitions in one transaction
+@app.route('/api/v1/create_disparitions', methods=['POST'])
+def create_disparitions():
+    """
+    Create several disparitions at once
+
+    This endpoint creates a batch of disparitions and their videos in a single transaction. The body is either a JSON array or NDJSON (Content-Type application/x-ndjson) of create_disparition payloads. Invalid records are reported and skipped, the others are inserted together.
+
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              disparition_date:
+                type: string
+              disparition_object_stolen:
+                type: integer
+              disparition_image_overview:
+                type: string
+              disparition_object:
+                type: string
+              camera_id:
+                type: integer
+              room_id:
+                type: integer
+              video_date:
+                type: string
+              video_length:
+                type: string
+              video_link:
+                type: string
+
+    responses:
+      200:
+        description: Disparitions created successfully
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Status message
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  index:
+                    type: integer
+                  disparition_id:
+                    type: integer
+                  video_id:
+                    type: integer
+                  error:
+                    type: string
+      400:
+        description: The body is not a JSON array or NDJSON
+      413:
+        description: Too many records in one request
+    """
+
+    payloads = []
+
+    if request.mimetype == 'application/x-ndjson':
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                payloads.append(json.loads(line))
+            except ValueError:
+                payloads.append(None)
+    else:
+        payloads = request.get_json(silent=True)
+        if not isinstance(payloads, list):
+            return jsonify({
+                'status': 'Body must be a JSON array or NDJSON'
+            }), 400
+
+    if len(payloads) > BULK_MAX_ITEMS:
+        return jsonify({
+            'status': 'Too many disparitions, at most %d per request' % BULK_MAX_ITEMS
+        }), 413
+
+    results = []
+    records = []
+    positions = []
+
+    for index, payload in enumerate(payloads):
+        try:
+            records.append(ingest.parse_record(payload, image_store))
+            positions.append(index)
+        except ingest.InvalidRecord as error:
+            results.append({
+                'index': index,
+                'error': str(error)
+            })
+
+    if records:
+        conn = get_db()
+        ids = ingest.insert_disparitions(conn, records)
+        publish_created(conn, ids)
+
+        for index, (disparition_id, video_id) in zip(positions, ids):
+            results.append({
+                'index': index,
+                'disparition_id': disparition_id,
+                'video_id': video_id
+            })
+
+    results.sort(key=lambda result: result['index'])
 
     return jsonify({
-        'status': 'Disparition created successfully'
+        'status': '%d disparitions created successfully' % len(records),
+        'results': results
     })
 
-    #
-
-# Route to delete all disparitions (and videos associated)
+# Route to delete disparitions (and videos associated), all of them or those of a house, room or date range
 @app.route('/api/v1/delete_disparitions', methods=['DELETE'])
 def delete_disparitions():
     """
-    Delete all disparitions
+    Delete disparitions
 
-    This endpoint deletes all disparitions in the system.
+    This endpoint deletes the disparitions matching every given filter, and their videos. Without any filter, all disparitions and videos in the system are deleted. Rows are deleted in batches of short transactions so ingestion is not blocked for the duration of the purge.
 
     ---
+    parameters:
+      - name: house_id
+        in: query
+        type: integer
+        required: false
+      - name: room_id
+        in: query
+        type: integer
+        required: false
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: Only disparitions dated at or after this ISO date
+      - name: until
+        in: query
+        type: string
+        required: false
+        description: Only disparitions dated before this ISO date
     responses:
       200:
         description: Disparitions deleted successfully
@@ -815,23 +2023,34 @@ def delete_disparitions():
             status:
               type: string
               description: Status message
+            deleted:
+              type: integer
+              description: Number of disparitions deleted
+      400:
+        description: Invalid date
     """
-    
-    conn = mysql.connector.connect(**db_config)
-    cursor = conn.cursor()
-    
-    # DELETE videos and disparitions
-    cursor.execute('DELETE FROM video')
-    conn.commit()
-    cursor.execute('DELETE FROM disparition')
-    conn.commit()
 
-    cursor.close()
-    conn.close()
+    try:
+        scope = purge.Scope(
+            house_id=request.args.get('house_id'),
+            room_id=request.args.get('room_id'),
+            since=purge.parse_date(request.args.get('since')),
+            until=purge.parse_date(request.args.get('until'))
+        )
+    except ValueError as error:
+        return jsonify({
+            'status': str(error)
+        }), 400
+
+    conn = get_db()
+    deleted = purge.delete_disparitions(conn, scope, pause=PURGE_PAUSE, on_delete=on_delete)
 
     return jsonify({
-        'status': 'Disparitions deleted successfully'
+        'status': 'Disparitions deleted successfully',
+        'deleted': deleted
     })
 
+boot_times.mark_imported()
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
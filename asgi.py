@@ -0,0 +1,555 @@
+# Async serving mode: the polling routes of app.py run natively on an aiomysql
+# pool, every other route is served by the Flask app through a WSGI bridge.
+# Selected at deploy time with SERVER_MODE=async, see gunicorn.conf.py
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import time
+
+import aiomysql
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header
+
+import events
+import metrics
+import pagination
+import repository
+import schema
+import streaming
+import versions
+from app import (
+    EVENTS_HEARTBEAT, STICKY_COOKIE, compressor, create_app, db_config, event_hub, metrics_registry, mirror,
+    permission_index, pool, reference_cache, replicas
+)
+
+flask_app = create_app()
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))
+POOL_RECYCLE = int(float(os.environ.get('DB_POOL_RECYCLE', 3600)))
+
+# Created by the worker at startup, after gunicorn forked it, the replica
+# pools in the order of replicas.replicas
+db = None
+replica_dbs = []
+
+# Pool the native routes of the current request read from
+reader = contextvars.ContextVar('reader', default=None)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await startup()
+    yield
+    await shutdown()
+
+
+async def create_pool(config):
+    return await aiomysql.create_pool(
+        host=config['host'],
+        port=config['port'],
+        user=config['user'],
+        password=config['password'],
+        db=config['database'],
+        minsize=1,
+        maxsize=POOL_SIZE,
+        pool_recycle=POOL_RECYCLE,
+        autocommit=True
+    )
+
+
+async def startup():
+    global db
+    db = await create_pool(db_config)
+    for replica in replicas.replicas:
+        replica_dbs.append(await create_pool(replica.config))
+
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for statement in schema.TABLES:
+                await cursor.execute(statement)
+
+            # Same triggers as schema.ensure, without them the tracked scopes are not versioned
+            try:
+                await cursor.execute(schema.EXISTING_TRIGGERS_SQL)
+                existing = {row[0] for row in await cursor.fetchall()}
+                for statement in schema.missing_triggers(existing):
+                    await cursor.execute(statement)
+                schema.set_tracked(True)
+            except aiomysql.Error as error:
+                logger.warning('Version triggers unavailable: %s', error)
+
+
+async def shutdown():
+    for pool in [db] + replica_dbs:
+        pool.close()
+        await pool.wait_closed()
+
+
+# Same routing as get_db of app.py: health and lag come from the checks of
+# the replica pools of the Flask app
+class ReadRouting:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            reader.set(read_pool(Request(scope)))
+        await self.app(scope, receive, send)
+
+
+def read_pool(request):
+    if request.method not in ('GET', 'HEAD') or not replica_dbs:
+        return db
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) >= time.time():
+            return db
+    except ValueError:
+        pass
+
+    pool = replicas.read_pool()
+    if pool is replicas.primary:
+        return db
+    return replica_dbs[replicas.replicas.index(pool)]
+
+
+# Adds to the request's metrics like the instrumented connections of app.py
+def record_query(pool_wait, db_time, queries, rows):
+    request_metrics = metrics.current()
+    if request_metrics is not None:
+        request_metrics.pool_wait += pool_wait
+        request_metrics.db_time += db_time
+        request_metrics.queries += queries
+        request_metrics.rows += rows
+
+
+async def fetchall(sql, params=()):
+    start = time.perf_counter()
+    async with (reader.get() or db).acquire() as conn:
+        acquired = time.perf_counter()
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            rows = await cursor.fetchall()
+
+    record_query(acquired - start, time.perf_counter() - acquired, 1, len(rows))
+    return rows
+
+
+# Encoded by the Flask provider so both modes send the same bytes
+def dumps(data):
+    return flask_app.json.dumps(data, separators=(',', ':'))
+
+
+def json_response(data, status_code=200):
+    return Response(
+        flask_app.json.encode(data, separators=(',', ':')) + b'\n', status_code, media_type=flask_app.json.mimetype
+    )
+
+
+def stream_response(sql, params, formatter):
+    async def generate():
+        start = time.perf_counter()
+        async with (reader.get() or db).acquire() as conn:
+            acquired = time.perf_counter()
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(sql, params)
+                record_query(acquired - start, time.perf_counter() - acquired, 1, 0)
+
+                separator = '['
+                while True:
+                    fetch_start = time.perf_counter()
+                    rows = await cursor.fetchmany(streaming.BATCH_SIZE)
+                    record_query(0.0, time.perf_counter() - fetch_start, 0, len(rows))
+                    if not rows:
+                        break
+                    yield separator + ','.join(dumps(formatter(row)) for row in rows)
+                    separator = ','
+
+                yield ']\n' if separator == ',' else '[]\n'
+
+    return StreamingResponse(generate(), media_type=flask_app.json.mimetype)
+
+
+def page_response(items, next_key):
+    return json_response({
+        'items': items,
+        'next_cursor': pagination.encode_cursor(next_key) if next_key is not None else None
+    })
+
+
+async def list_response(request, name, full_sql, full_params=(), conditions=(), params=(), stream=False,
+                        full_order=None):
+    fields = None
+    if name in repository.PROJECTIONS:
+        fields = repository.parse_fields(name, request.query_params.get('fields'))
+    select, order_by, formatter, key = repository.projection(name, fields)
+
+    if pagination.requested(request.query_params):
+        limit, after = pagination.page_args(len(order_by), request.query_params)
+        rows = await fetchall(*pagination.page_query(select, order_by, limit, after, conditions, params))
+        items, next_key = repository.page_result(name, rows[:limit], len(rows) > limit, fields)
+
+        return page_response(items, next_key)
+
+    if fields is not None:
+        full_sql, formatter = repository.list_query(name, fields, conditions, full_order)
+        full_params = params
+
+    if stream:
+        return stream_response(full_sql, full_params, formatter)
+
+    rows = await fetchall(full_sql, full_params)
+    return json_response([formatter(row) for row in rows])
+
+
+def accept_encodings(request):
+    return parse_accept_header(request.headers.get('accept-encoding'))
+
+
+# Same compression as compress_response of app.py, responses of the Flask
+# app come out of the bridge compressed already
+def compress(request, response):
+    if (
+        response.status_code != 200 or 'content-encoding' in response.headers
+        or response.media_type in ('text/event-stream', None)
+    ):
+        return response
+
+    response.headers.add_vary_header('Accept-Encoding')
+
+    encoding = compressor.negotiate(accept_encodings(request))
+    if encoding is None:
+        return response
+
+    etag = response.headers.get('etag', '').strip('"') or None
+    key = getattr(request.state, 'compression_key', None)
+
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = compressor.compress_async_stream(response.body_iterator, encoding, key)
+        if 'content-length' in response.headers:
+            del response.headers['content-length']
+    else:
+        if len(response.body) < compressor.min_size:
+            return response
+        response.body = compressor.compress_body(response.body, encoding, key)
+        response.headers['content-length'] = str(len(response.body))
+
+    response.headers['content-encoding'] = encoding
+    if etag:
+        response.headers['etag'] = '"%s-%s"' % (etag, encoding)
+
+    return response
+
+
+# Every native route goes through here, like the request hooks of app.py:
+# metrics recorded under the Flask rule of the route, Server-Timing and
+# compression. Streamed responses are recorded once their body is sent
+def native(path, route):
+    rule = path.replace('{', '<').replace('}', '>')
+
+    @functools.wraps(route)
+    async def handler(request):
+        request_metrics = metrics.RequestMetrics()
+        metrics.native_request.set(request_metrics)
+
+        try:
+            response = compress(request, await route(request))
+        except Exception as error:
+            request_metrics.status = 400 if isinstance(error, (pagination.InvalidPageArgs, repository.InvalidFields)) else 500
+            metrics_registry.observe(rule, request_metrics)
+            raise
+
+        request_metrics.status = response.status_code
+        response.headers['server-timing'] = request_metrics.server_timing()
+        response.headers['timing-allow-origin'] = '*'
+
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = observed(response.body_iterator, rule, request_metrics)
+        else:
+            metrics_registry.observe(rule, request_metrics)
+
+        return response
+
+    return Route(path, handler, methods=['GET'])
+
+
+async def observed(chunks, rule, request_metrics):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        metrics_registry.observe(rule, request_metrics)
+
+
+# The permission index of the Flask app. Its lookups may load from MySQL,
+# so they run in a thread, on a pooled connection taken only when needed
+async def from_permission_index(method, *args):
+    def call():
+        borrowed = []
+
+        def connect():
+            if not borrowed:
+                borrowed.append(pool.acquire())
+            return borrowed[0]
+
+        try:
+            return method(connect, *args)
+        finally:
+            for conn in borrowed:
+                pool.release(conn)
+
+    return await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, call)
+
+
+# Same ETags as the versioned routes of app.py, a match is answered before
+# the main query runs
+async def conditional(request, scopes, build):
+    # Without a change signal every request is built
+    if not schema.tracked(scopes):
+        return await build()
+
+    numbers = mirror.versions(scopes) if mirror is not None else None
+    if numbers is None:
+        found = dict(await fetchall(versions.read_sql(scopes), scopes))
+        numbers = [found.get(scope, 0) for scope in scopes]
+    full_path = request.url.path + '?' + request.url.query
+    etag = versions.make_etag(numbers, scopes, full_path)
+    # Compressed bodies are cached for this exact path, never by ETag alone
+    request.state.compression_key = versions.cache_key(numbers, scopes, full_path)
+
+    sent = [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]
+    for variant in compressor.etag_variants(etag):
+        if '"%s"' % variant in sent or '*' in sent:
+            return Response(status_code=304, headers={'ETag': '"%s"' % variant})
+
+    # Same version already compressed for this encoding, skip the query
+    body, encoding = compressor.cached(request.state.compression_key, accept_encodings(request))
+    if body is not None:
+        return Response(body, media_type=flask_app.json.mimetype, headers={
+            'Content-Encoding': encoding,
+            'Vary': 'Accept-Encoding',
+            'ETag': '"%s-%s"' % (etag, encoding)
+        })
+
+    response = await build()
+    response.headers['ETag'] = '"%s"' % etag
+    return response
+
+
+async def reference_name(table, id):
+    name = reference_cache.peek(table, id)
+    if name is None:
+        rows = await fetchall('SELECT %s_name FROM %s WHERE %s_id = %%s' % (table, table, table), (id,))
+        if rows:
+            name = rows[0][0]
+            reference_cache.store(table, id, name)
+    return name
+
+
+async def get_users(request):
+    return await list_response(request, 'users', repository.USERS_SQL, stream=True)
+
+
+# Answer a list from the local mirror when it is enabled and fresh, None otherwise
+def mirrored(request, name, key_size):
+    # The mirror holds whole rows, a projection is selected from MySQL
+    if mirror is None or request.query_params.get('fields'):
+        return None
+
+    if pagination.requested(request.query_params):
+        limit, after = pagination.page_args(key_size, request.query_params)
+        page = getattr(mirror, 'page_' + name)(limit, after)
+        if page is None:
+            return None
+        items, next_key = page
+        return page_response(items, next_key)
+
+    data = getattr(mirror, name)()
+    return json_response(data) if data is not None else None
+
+
+async def get_houses(request):
+    async def build():
+        return (
+            mirrored(request, 'houses', 1)
+            or await list_response(request, 'houses', repository.HOUSES_SELECT)
+        )
+
+    return await conditional(request, ['house'], build)
+
+
+async def get_rooms(request):
+    async def build():
+        return (
+            mirrored(request, 'rooms', 1)
+            or await list_response(request, 'rooms', repository.ROOMS_SELECT)
+        )
+
+    return await conditional(request, ['room'], build)
+
+
+async def get_videos(request):
+    return await list_response(request, 'videos', repository.VIDEOS_SELECT, stream=True)
+
+
+async def get_can_consult(request):
+    response = mirrored(request, 'can_consult', 2)
+    if response is not None:
+        return response
+
+    # The permission index holds whole rows, a projection is selected from MySQL
+    if request.query_params.get('fields'):
+        return await list_response(request, 'can_consult', repository.CAN_CONSULT_SQL)
+
+    if pagination.requested(request.query_params):
+        limit, after = pagination.page_args(2, request.query_params)
+        return page_response(*await from_permission_index(permission_index.page_can_consult, limit, after))
+
+    return json_response(await from_permission_index(permission_index.can_consult))
+
+
+async def get_houses_of_a_user(request):
+    user_id = request.path_params['user_id']
+    data = mirror.houses_of_user(user_id) if mirror is not None else None
+    if data is None:
+        data = await from_permission_index(permission_index.houses_of_user, user_id)
+    return json_response(data)
+
+
+async def get_rooms_of_a_house(request):
+    house_id = request.path_params['house_id']
+    data = mirror.rooms_of_house(house_id) if mirror is not None else None
+    if data is None:
+        data = [repository.room_row(row) for row in await fetchall(repository.ROOMS_OF_HOUSE_SQL, (house_id,))]
+    return json_response(data)
+
+
+async def get_cameras_of_a_house(request):
+    async def build():
+        house_id = request.path_params['house_id']
+        data = mirror.cameras_of_house(house_id) if mirror is not None else None
+        if data is None:
+            data = [repository.camera_row(row) for row in await fetchall(repository.CAMERAS_OF_HOUSE_SQL, (house_id,))]
+        return json_response(data)
+
+    return await conditional(request, ['camera'], build)
+
+
+async def get_videos_of_a_room_of_a_house(request):
+    house_id = request.path_params['house_id']
+    room_id = request.path_params['room_id']
+
+    # Independent lookups, each on its own pooled connection
+    house_name, room_name, video_results = await asyncio.gather(
+        reference_name('house', house_id),
+        reference_name('room', room_id),
+        fetchall('SELECT * FROM video WHERE room_id = %s', (room_id,))
+    )
+
+    return json_response({
+        'house_id': house_id,
+        'house_name': house_name,
+        'room_id': room_id,
+        'room_name': room_name,
+        'videos': [repository.room_video_row(row) for row in video_results]
+    })
+
+
+async def get_disparitions_of_a_house(request):
+    house_id = request.path_params['house_id']
+
+    return await conditional(
+        request,
+        ['room', 'camera', 'disparition', 'disparition:' + house_id],
+        lambda: list_response(
+            request, 'disparitions', repository.DISPARITIONS_OF_HOUSE_SQL, (house_id,),
+            conditions=['r.house_id = %s'], params=[house_id], stream=True, full_order=('d.disparition_id',)
+        )
+    )
+
+
+# Each client waits on the event loop instead of a thread, so a worker serves
+# any number of them. Subscribing runs its queries on the pool of the Flask
+# app, in a thread
+async def get_disparitions_stream_of_a_house(request):
+    house_id = request.path_params['house_id']
+
+    last_event_id = request.headers.get('last-event-id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    loop = asyncio.get_running_loop()
+    subscription = events.AsyncSubscription(house_id, event_hub.buffer_size, loop)
+
+    def subscribe():
+        with pool.connection() as conn:
+            event_hub.subscribe(conn, house_id, last_event_id, subscription)
+
+    await loop.run_in_executor(None, subscribe)
+
+    async def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = await subscription.get(EVENTS_HEARTBEAT)
+                if event is not None:
+                    yield 'id: %d\nevent: disparition\ndata: %s\n\n' % event
+                elif subscription.dropped:
+                    yield 'event: dropped\ndata: {}\n\n'
+                    break
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def invalid_page_args(request, error):
+    return json_response({
+        'status': str(error)
+    }, 400)
+
+
+app = Starlette(
+    routes=[
+        native('/api/v1/get_users', get_users),
+        native('/api/v1/get_houses', get_houses),
+        native('/api/v1/get_rooms', get_rooms),
+        native('/api/v1/get_videos', get_videos),
+        native('/api/v1/get_canconsult', get_can_consult),
+        native('/api/v1/get_houses/{user_id}', get_houses_of_a_user),
+        native('/api/v1/get_rooms/{house_id}', get_rooms_of_a_house),
+        native('/api/v1/get_cameras/{house_id}', get_cameras_of_a_house),
+        native('/api/v1/get_videos/{house_id}/{room_id}', get_videos_of_a_room_of_a_house),
+        native('/api/v1/get_disparitions/{house_id}', get_disparitions_of_a_house),
+        native('/api/v1/get_disparitions_stream/{house_id}', get_disparitions_stream_of_a_house),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[
+        # Same policy as CORS(app) in app.py
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(ReadRouting),
+    ],
+    exception_handlers={
+        pagination.InvalidPageArgs: invalid_page_args,
+        repository.InvalidFields: invalid_page_args,
+    },
+    lifespan=lifespan
+)
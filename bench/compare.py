@@ -0,0 +1,45 @@
+# Compare two result files written by run.py, route by route.
+#
+#   python bench/compare.py bench/results/before.json bench/results/after.json
+
+import json
+import sys
+
+METRICS = ('p50', 'p95', 'p99')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if not before:
+        return '      n/a'
+    return '%+8.1f%%' % ((after - before) * 100.0 / before)
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit('usage: compare.py BEFORE.json AFTER.json')
+
+    before, after = load(sys.argv[1]), load(sys.argv[2])
+    print('%s -> %s' % ((before.get('commit') or '?')[:10], (after.get('commit') or '?')[:10]))
+
+    for name, result in after['routes'].items():
+        previous = before['routes'].get(name)
+        if previous is None:
+            print('%-26s new route' % name)
+            continue
+
+        columns = ['%s %s' % (metric, change(previous['latency_ms'][metric], result['latency_ms'][metric]))
+                   for metric in METRICS]
+        columns.append('req/s %s' % change(previous['throughput'], result['throughput']))
+        columns.append('queries/req %.2f -> %.2f' % (
+            previous['db_queries_per_request'], result['db_queries_per_request']
+        ))
+        print('%-26s %s' % (name, '  '.join(columns)))
+
+
+if __name__ == '__main__':
+    main()
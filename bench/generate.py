@@ -0,0 +1,205 @@
+# Fill a local MySQL/MariaDB database with a synthetic objura dataset.
+#
+#   DB_HOST=127.0.0.1 DB_USER=root DB_PASSWORD=... DB_NAME=objura_bench \
+#       python bench/generate.py --houses 10000 --disparitions 1000000
+#
+# The same DB_* variables point app.py at the generated database. The
+# dataset only depends on the arguments and --seed, so two runs with the
+# same arguments produce the same tables.
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import mysql.connector
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import rollups  # noqa: E402
+
+TABLES = ('video', 'disparition', 'can_consult', 'camera', 'room', 'house', 'user')
+
+OBJECTS = ('laptop', 'phone', 'wallet', 'keys', 'bag', 'watch', 'tablet', 'camera', 'jewel', 'bike')
+ROOMS = ('Living room', 'Kitchen', 'Bedroom', 'Office', 'Garage', 'Hall', 'Bathroom', 'Cellar')
+
+START = datetime.datetime(2023, 1, 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset for the benchmarks.')
+    parser.add_argument('--houses', type=int, default=1000)
+    parser.add_argument('--rooms-per-house', type=int, default=5)
+    parser.add_argument('--cameras-per-house', type=int, default=3)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--houses-per-user', type=int, default=2)
+    parser.add_argument('--disparitions', type=int, default=100000)
+    parser.add_argument('--image-size', type=int, default=256, help='bytes of disparition_image_overview')
+    parser.add_argument('--days', type=int, default=365, help='span of the disparition dates')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='append to the existing tables instead of emptying them')
+    return parser.parse_args()
+
+
+def connect():
+    return mysql.connector.connect(
+        user=os.environ.get('DB_USER', 'root'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        host=os.environ.get('DB_HOST', '127.0.0.1'),
+        port=int(os.environ.get('DB_PORT', 3306)),
+        database=os.environ.get('DB_NAME', 'objura_bench')
+    )
+
+
+def create_schema(cursor, keep):
+    with open(os.path.join(HERE, 'schema.sql')) as f:
+        statements = [statement.strip() for statement in f.read().split(';')]
+
+    for statement in statements:
+        lines = [line for line in statement.splitlines() if not line.startswith('--')]
+        if lines:
+            cursor.execute('\n'.join(lines))
+
+    if not keep:
+        for table in TABLES + ('api_version', 'disparition_tombstone'):
+            cursor.execute("SHOW TABLES LIKE %s", (table,))
+            if cursor.fetchall():
+                cursor.execute('TRUNCATE TABLE `%s`' % table)
+
+
+def insert(conn, cursor, sql, rows, chunk_size):
+    count = 0
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            cursor.executemany(sql, chunk)
+            conn.commit()
+            count += len(chunk)
+            chunk = []
+
+    if chunk:
+        cursor.executemany(sql, chunk)
+        conn.commit()
+        count += len(chunk)
+
+    return count
+
+
+def users(args):
+    for i in range(1, args.users + 1):
+        yield ('user%d@example.com' % i, 'First%d' % i, 'Last%d' % i, 'x' * 60, i)
+
+
+def houses(args):
+    for house_id in range(1, args.houses + 1):
+        yield (house_id, 'House %d' % house_id)
+
+
+def rooms(args):
+    for house_id in range(1, args.houses + 1):
+        for i in range(args.rooms_per_house):
+            room_id = (house_id - 1) * args.rooms_per_house + i + 1
+            yield (room_id, ROOMS[i % len(ROOMS)], house_id)
+
+
+def cameras(args):
+    for house_id in range(1, args.houses + 1):
+        for i in range(args.cameras_per_house):
+            camera_id = (house_id - 1) * args.cameras_per_house + i + 1
+            yield (camera_id, 'Camera %d' % (i + 1), house_id)
+
+
+def can_consult(args, rng):
+    per_user = min(args.houses_per_user, args.houses)
+    for user_id in range(1, args.users + 1):
+        for house_id in sorted(rng.sample(range(1, args.houses + 1), per_user)):
+            yield (user_id, house_id)
+
+
+# One video per disparition, both dated at the same moment
+def disparitions_and_videos(args, rng):
+    image = 'i' * args.image_size
+    seconds = args.days * 86400
+
+    for disparition_id in range(1, args.disparitions + 1):
+        house_id = rng.randint(1, args.houses)
+        room_id = (house_id - 1) * args.rooms_per_house + rng.randint(1, args.rooms_per_house)
+        camera_id = None
+        if args.cameras_per_house:
+            camera_id = (house_id - 1) * args.cameras_per_house + rng.randint(1, args.cameras_per_house)
+        date = START + datetime.timedelta(seconds=rng.randrange(seconds))
+        stolen = rng.random() < 0.3
+
+        yield (
+            (disparition_id, date, stolen, image, rng.choice(OBJECTS), camera_id, room_id),
+            (disparition_id, date, datetime.timedelta(seconds=rng.randint(5, 300)), stolen,
+             'https://videos.example.com/%d.mp4' % disparition_id, room_id, disparition_id)
+        )
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    conn = connect()
+    cursor = conn.cursor()
+    create_schema(cursor, args.keep)
+
+    steps = [
+        ('user', 'INSERT INTO user (user_email, user_firstname, user_lastname, user_password, user_id) '
+                 'VALUES (%s, %s, %s, %s, %s)', users(args)),
+        ('house', 'INSERT INTO house (house_id, house_name) VALUES (%s, %s)', houses(args)),
+        ('room', 'INSERT INTO room (room_id, room_name, house_id) VALUES (%s, %s, %s)', rooms(args)),
+        ('camera', 'INSERT INTO camera (camera_id, camera_name, house_id) VALUES (%s, %s, %s)', cameras(args)),
+        ('can_consult', 'INSERT INTO can_consult (user_id, house_id) VALUES (%s, %s)', can_consult(args, rng)),
+    ]
+
+    for table, sql, rows in steps:
+        started = time.perf_counter()
+        count = insert(conn, cursor, sql, rows, args.chunk_size)
+        print('%-12s %9d rows  %6.1fs' % (table, count, time.perf_counter() - started), file=sys.stderr)
+
+    started = time.perf_counter()
+    pending = []
+    count = 0
+    for pair in disparitions_and_videos(args, rng):
+        pending.append(pair)
+        if len(pending) >= args.chunk_size:
+            count += write_disparitions(conn, cursor, pending)
+            pending = []
+    if pending:
+        count += write_disparitions(conn, cursor, pending)
+    print('%-12s %9d rows  %6.1fs' % ('disparition', count, time.perf_counter() - started), file=sys.stderr)
+
+    # The API keeps the statistics up to date, rows written here are counted once
+    started = time.perf_counter()
+    rollups.rebuild(conn)
+    print('%-12s %9s       %6.1fs' % ('rollups', '', time.perf_counter() - started), file=sys.stderr)
+
+    cursor.close()
+    conn.close()
+
+
+def write_disparitions(conn, cursor, pairs):
+    cursor.executemany(
+        'INSERT INTO disparition (disparition_id, disparition_date, disparition_object_stolen, '
+        'disparition_image_overview, disparition_object, camera_id, room_id) VALUES (%s, %s, %s, %s, %s, %s, %s)',
+        [disparition for disparition, video in pairs]
+    )
+    cursor.executemany(
+        'INSERT INTO video (video_id, video_date, video_length, video_object_stolen, video_link, room_id, '
+        'disparition_id) VALUES (%s, %s, %s, %s, %s, %s, %s)',
+        [video for disparition, video in pairs]
+    )
+    conn.commit()
+    return len(pairs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Measure the read routes of the API against a database filled by generate.py.
+#
+#   DB_HOST=127.0.0.1 DB_USER=root DB_PASSWORD=... DB_NAME=objura_bench \
+#       python bench/run.py --requests 500 --concurrency 8 --output bench/results/$(git rev-parse --short HEAD).json
+#
+# Without --base-url the Flask app is driven in process through its test
+# client, with --base-url a running server (gunicorn, SERVER_MODE=async, ...)
+# is measured over HTTP. Routes are run one after the other so the DB
+# queries per request can be read from the server's Questions counter,
+# which is only exact when nothing else uses the database meanwhile.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import mysql.connector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> path template, filled from the dataset arguments
+ROUTES = {
+    'get_users': '/api/v1/get_users',
+    'get_users_page': '/api/v1/get_users?limit=100',
+    'get_houses': '/api/v1/get_houses',
+    'get_houses_page': '/api/v1/get_houses?limit=100',
+    'get_rooms': '/api/v1/get_rooms',
+    'get_videos_page': '/api/v1/get_videos?limit=100',
+    'get_canconsult': '/api/v1/get_canconsult',
+    'get_houses_of_user': '/api/v1/get_houses/{user_id}',
+    'get_rooms_of_house': '/api/v1/get_rooms/{house_id}',
+    'get_cameras_of_house': '/api/v1/get_cameras/{house_id}',
+    'get_videos_of_room': '/api/v1/get_videos/{house_id}/{room_id}',
+    'get_disparitions': '/api/v1/get_disparitions/{house_id}',
+    'get_disparitions_page': '/api/v1/get_disparitions/{house_id}?limit=50',
+    'get_disparitions_slim': '/api/v1/get_disparitions/{house_id}?fields=disparition_id,disparition_date,disparition_object,room_name',
+    'get_disparitions_history': '/api/v1/get_disparitions_history/{house_id}',
+    'get_house_snapshot': '/api/v1/get_house_snapshot/{house_id}',
+    'get_statistics': '/api/v1/get_statistics/{house_id}?bucket=month&group_by=room',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the API routes.')
+    parser.add_argument('--base-url', help='measure a running server instead of the app in process')
+    parser.add_argument('--routes', help='comma separated subset of: ' + ', '.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--houses', type=int, default=1000, help='as given to generate.py')
+    parser.add_argument('--rooms-per-house', type=int, default=5, help='as given to generate.py')
+    parser.add_argument('--users', type=int, default=2000, help='as given to generate.py')
+    parser.add_argument('--header', action='append', default=[], help='extra request header, Name: value')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    return parser.parse_args()
+
+
+def connect():
+    return mysql.connector.connect(
+        user=os.environ.get('DB_USER', 'root'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        host=os.environ.get('DB_HOST', '127.0.0.1'),
+        port=int(os.environ.get('DB_PORT', 3306)),
+        database=os.environ.get('DB_NAME', 'objura_bench')
+    )
+
+
+def questions(conn):
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS LIKE 'Questions'")
+    value = int(cursor.fetchone()[1])
+    cursor.close()
+    return value
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class HttpClient:
+    def __init__(self, base_url, headers):
+        self.base_url = base_url.rstrip('/')
+        self.headers = headers
+
+    def get(self, path):
+        request = urllib.request.Request(self.base_url + path, headers=self.headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, len(error.read())
+
+
+class InProcessClient:
+    def __init__(self, headers):
+        sys.path.insert(0, ROOT)
+        from app import create_app
+
+        self.app = create_app()
+        self.headers = headers
+
+    def get(self, path):
+        # One test client per call, they are not meant to be shared by threads
+        response = self.app.test_client().get(path, headers=self.headers)
+        return response.status_code, len(response.get_data())
+
+
+def paths(template, count, args, rng):
+    result = []
+    for _ in range(count):
+        house_id = rng.randint(1, args.houses)
+        result.append(template.format(
+            user_id=rng.randint(1, args.users),
+            house_id=house_id,
+            room_id=(house_id - 1) * args.rooms_per_house + rng.randint(1, args.rooms_per_house)
+        ))
+    return result
+
+
+def run(client, requests, concurrency):
+    latencies = []
+    statuses = {}
+    sizes = []
+    lock = threading.Lock()
+    remaining = list(reversed(requests))
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                path = remaining.pop()
+
+            started = time.perf_counter()
+            status, size = client.get(path)
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                sizes.append(size)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, statuses, sizes, time.perf_counter() - started
+
+
+def measure(client, monitor, name, template, args, rng):
+    if args.warmup:
+        run(client, paths(template, args.warmup, args, rng), args.concurrency)
+
+    before = questions(monitor)
+    latencies, statuses, sizes, duration = run(client, paths(template, args.requests, args, rng), args.concurrency)
+    # The SHOW STATUS of the second reading counts itself
+    queries = questions(monitor) - before - 1
+
+    return {
+        'requests': len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput': round(len(latencies) / duration, 2),
+        'latency_ms': {
+            'mean': round(statistics.mean(latencies) * 1000, 3),
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(max(latencies) * 1000, 3),
+        },
+        'db_queries_per_request': round(queries / len(latencies), 2),
+        'response_bytes': round(statistics.mean(sizes)),
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    headers = dict(header.split(':', 1) for header in args.header)
+    headers = {name.strip(): value.strip() for name, value in headers.items()}
+
+    names = args.routes.split(',') if args.routes else list(ROUTES)
+    unknown = [name for name in names if name not in ROUTES]
+    if unknown:
+        sys.exit('Unknown routes: ' + ', '.join(unknown))
+
+    client = HttpClient(args.base_url, headers) if args.base_url else InProcessClient(headers)
+    monitor = connect()
+
+    results = {}
+    for name in names:
+        results[name] = measure(client, monitor, name, ROUTES[name], args, rng)
+        latency = results[name]['latency_ms']
+        print('%-26s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %8.1f req/s  %6.2f queries/req' % (
+            name, latency['p50'], latency['p95'], latency['p99'],
+            results[name]['throughput'], results[name]['db_queries_per_request']
+        ), file=sys.stderr)
+
+    monitor.close()
+
+    report = {
+        'commit': commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'target': args.base_url or 'in-process',
+        'parameters': {
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'houses': args.houses,
+            'rooms_per_house': args.rooms_per_house,
+            'users': args.users,
+            'headers': headers,
+            'seed': args.seed,
+        },
+        'routes': results,
+    }
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+-- Schema of the tables read and written by app.py, for local benchmark databases.
+-- Column order follows the SELECT * mappings of the routes.
+
+CREATE TABLE IF NOT EXISTS user (
+    user_email VARCHAR(255) NOT NULL,
+    user_firstname VARCHAR(255),
+    user_lastname VARCHAR(255),
+    user_password VARCHAR(255) NOT NULL,
+    user_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    UNIQUE KEY user_email (user_email)
+);
+
+CREATE TABLE IF NOT EXISTS house (
+    house_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    house_name VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS room (
+    room_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    room_name VARCHAR(255) NOT NULL,
+    house_id INT NOT NULL,
+    KEY house_id (house_id)
+);
+
+CREATE TABLE IF NOT EXISTS camera (
+    camera_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    camera_name VARCHAR(255) NOT NULL,
+    house_id INT NOT NULL,
+    KEY house_id (house_id)
+);
+
+CREATE TABLE IF NOT EXISTS can_consult (
+    user_id INT NOT NULL,
+    house_id INT NOT NULL,
+    PRIMARY KEY (user_id, house_id)
+);
+
+CREATE TABLE IF NOT EXISTS disparition (
+    disparition_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    disparition_date DATETIME NOT NULL,
+    disparition_object_stolen TINYINT(1) NOT NULL,
+    disparition_image_overview MEDIUMTEXT,
+    disparition_object VARCHAR(255),
+    camera_id INT,
+    room_id INT NOT NULL,
+    KEY room_id (room_id),
+    KEY disparition_date (disparition_date, disparition_id)
+);
+
+CREATE TABLE IF NOT EXISTS video (
+    video_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    video_date DATETIME,
+    video_length TIME,
+    video_object_stolen TINYINT(1),
+    video_link VARCHAR(512),
+    room_id INT,
+    disparition_id INT,
+    KEY room_id (room_id),
+    KEY disparition_id (disparition_id)
+);
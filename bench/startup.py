@@ -0,0 +1,87 @@
+# Measure the cold import of the app, as paid by every new worker.
+#
+#   python bench/startup.py --runs 10 --output bench/results/startup-$(git rev-parse --short HEAD).json
+#
+# Each run imports app.py in a fresh interpreter. The import time is the
+# one the app records itself (metrics.BootTimes), the slowest modules come
+# from python -X importtime of the last run.
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = 'import json, app; print(json.dumps(app.boot_times.stats()))'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the app.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15, help='slowest modules to report')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    return parser.parse_args()
+
+
+def import_once(importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', SCRIPT]
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])['import_seconds'], result.stderr
+
+
+# Lines of -X importtime are "import time: self [us] | cumulative | package"
+def slowest_modules(stderr, top):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented, their time is part of the cumulative time of the importer
+        if name.startswith('  '):
+            continue
+        modules.append((int(cumulative_us), int(self_us), name.strip()))
+
+    modules.sort(reverse=True)
+
+    return [
+        {'module': name, 'cumulative_ms': round(cumulative / 1000, 1), 'self_ms': round(own / 1000, 1)}
+        for cumulative, own, name in modules[:top]
+    ]
+
+
+def main():
+    args = parse_args()
+
+    seconds = [import_once()[0] for _ in range(args.runs)]
+    last, stderr = import_once(importtime=True)
+
+    report = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'runs': args.runs,
+        'import_ms': {
+            'mean': round(statistics.mean(seconds) * 1000, 1),
+            'min': round(min(seconds) * 1000, 1),
+            'max': round(max(seconds) * 1000, 1),
+        },
+        'slowest_modules': slowest_modules(stderr, args.top),
+    }
+
+    print('import mean %.1fms  min %.1fms  max %.1fms' % (
+        report['import_ms']['mean'], report['import_ms']['min'], report['import_ms']['max']
+    ), file=sys.stderr)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+
+import statements
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache whose entries also expire `ttl` seconds after
+    they were stored. A ttl of 0 disables expiry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self._data[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+class ReferenceCache:
+    """
+    Cache of house, room and camera names keyed by id.
+
+    A single miss is loaded with the prepared `<table>_name` statement and
+    several misses with one `IN (...)` query per table. Write routes must
+    call `invalidate` for the rows they change.
+    """
+
+    TABLES = {
+        'house': ('house_id', 'house_name'),
+        'room': ('room_id', 'room_name'),
+        'camera': ('camera_id', 'camera_name'),
+    }
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self._caches = {table: LRUCache(maxsize, ttl) for table in self.TABLES}
+
+    def names(self, conn, table, ids):
+        cache = self._caches[table]
+        found = {}
+        missing = []
+
+        for id in ids:
+            name = cache.get(str(id))
+            if name is MISSING:
+                missing.append(id)
+            else:
+                found[str(id)] = name
+
+        if len(missing) == 1:
+            rows = statements.run(conn, table + '_name', (missing[0],))
+            for (name,) in rows:
+                cache.set(str(missing[0]), name)
+                found[str(missing[0])] = name
+        elif missing:
+            id_column, name_column = self.TABLES[table]
+            placeholders = ', '.join(['%s'] * len(missing))
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT %s, %s FROM %s WHERE %s IN (%s)' % (id_column, name_column, table, id_column, placeholders),
+                missing
+            )
+            for id, name in cursor.fetchall():
+                cache.set(str(id), name)
+                found[str(id)] = name
+            cursor.close()
+
+        return found
+
+    def name(self, conn, table, id):
+        return self.names(conn, table, [id]).get(str(id))
+
+    # Cache-only access for callers that load misses themselves
+    def peek(self, table, id):
+        name = self._caches[table].get(str(id))
+        return None if name is MISSING else name
+
+    def store(self, table, id, name):
+        self._caches[table].set(str(id), name)
+
+    def invalidate(self, table, id=None):
+        if id is None:
+            self._caches[table].clear()
+        else:
+            self._caches[table].invalidate(str(id))
+
+    def clear(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    def stats(self):
+        return {table: cache.stats() for table, cache in self._caches.items()}
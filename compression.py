@@ -0,0 +1,188 @@
+import zlib
+
+from flask import request
+
+from cache import LRUCache, MISSING
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first when the client accepts several
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+class _Gzip:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, level):
+        # Brotli qualities go up to 11, the configured level is a zlib one
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class Compressor:
+    """
+    Content-negotiated gzip/brotli compression of the app's responses.
+
+    Buffered responses are compressed when they are at least `min_size`
+    bytes, streamed ones chunk by chunk as they are produced. Compressed
+    bodies of versioned responses are kept in a small LRU cache keyed by
+    (versions.cache_key, encoding), the exact path, scopes and versions of
+    the representation, so repeated polls of an unchanged resource are
+    served without compressing, or even querying, again. Entries expire
+    after `cache_ttl` seconds, which bounds how long a change the version
+    counters missed can be hidden.
+    """
+
+    def __init__(self, min_size=1024, level=6, cache_size=64, cache_max_bytes=4 * 1024 * 1024, cache_ttl=60):
+        self.min_size = min_size
+        self.level = level
+        self.cache_max_bytes = cache_max_bytes
+        self._cache = LRUCache(cache_size, ttl=cache_ttl)
+
+    def negotiate(self, accept=None):
+        """Preferred encoding the client accepts, `accept` defaults to the encodings of the Flask request."""
+
+        accept = request.accept_encodings if accept is None else accept
+        for encoding in ENCODINGS:
+            if accept[encoding]:
+                return encoding
+        return None
+
+    # Every ETag this module may have sent for a given version
+    def etag_variants(self, etag):
+        return [etag] + ['%s-%s' % (etag, encoding) for encoding in ENCODINGS]
+
+    def cached(self, key, accept=None):
+        encoding = self.negotiate(accept)
+        if encoding is None:
+            return None, None
+
+        body = self._cache.get((key, encoding))
+        if body is MISSING:
+            return None, None
+
+        return body, encoding
+
+    def process(self, response, key=None):
+        """Compress a Flask response, `key` caches the body, see versions.cache_key."""
+
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+
+        # Buffering in the compressor would hold back events and heartbeats
+        if response.mimetype == 'text/event-stream':
+            return response
+
+        # Images are compressed already
+        if response.mimetype.startswith('image/'):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding, key)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+
+            response.set_data(self.compress_body(body, encoding, key))
+
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag('%s-%s' % (etag, encoding), weak)
+
+        return response
+
+    def compress_body(self, body, encoding, key=None):
+        compressed = self._cache.get((key, encoding)) if key else MISSING
+        if compressed is MISSING:
+            compressed = self._compress(body, encoding)
+            self._store(key, encoding, compressed)
+        return compressed
+
+    async def compress_async_stream(self, chunks, encoding, key=None):
+        """Async counterpart of the streamed compression, for the native routes of asgi.py."""
+
+        compressor = self._compressor(encoding)
+        kept = []
+        size = 0
+
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                size += len(data)
+                if size <= self.cache_max_bytes:
+                    kept.append(data)
+                yield data
+
+        data = compressor.flush()
+        size += len(data)
+        kept.append(data)
+        yield data
+
+        if key and size <= self.cache_max_bytes:
+            self._store(key, encoding, b''.join(kept))
+
+    def stats(self):
+        return dict(self._cache.stats(), encodings=list(ENCODINGS), level=self.level, min_size=self.min_size)
+
+    def _compressor(self, encoding):
+        return _Brotli(self.level) if encoding == 'br' else _Gzip(self.level)
+
+    def _compress(self, body, encoding):
+        compressor = self._compressor(encoding)
+        return compressor.compress(body) + compressor.flush()
+
+    def _compress_stream(self, chunks, encoding, key):
+        compressor = self._compressor(encoding)
+        kept = []
+        size = 0
+
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                size += len(data)
+                if size <= self.cache_max_bytes:
+                    kept.append(data)
+                yield data
+
+        data = compressor.flush()
+        size += len(data)
+        kept.append(data)
+        yield data
+
+        if key and size <= self.cache_max_bytes:
+            self._store(key, encoding, b''.join(kept))
+
+    def _store(self, key, encoding, body):
+        if key and len(body) <= self.cache_max_bytes:
+            self._cache.set((key, encoding), body)
@@ -0,0 +1,324 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out before the timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of MySQL connections built on a db_config dict.
+
+    Connections are opened lazily, so a pool created before gunicorn forks
+    its workers does not share any socket between processes. Each checkout
+    optionally pings the server, connections older than `recycle` seconds
+    are closed and replaced, and callers wait at most `timeout` seconds for
+    a free slot. `wrap`, when given, is applied to every new connection and
+    the pool hands out what it returns.
+    """
+
+    def __init__(self, config, size=5, timeout=10, recycle=3600, pre_ping=True, wrap=None):
+        self.config = dict(config)
+        self.wrap = wrap
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._created_at = {}
+
+        self._in_use = 0
+        self._opened = 0
+        self._closed = 0
+        self._recycled = 0
+        self._ping_failures = 0
+        self._timeouts = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout('No database connection available after %ss' % self.timeout)
+        waited = time.monotonic() - start
+
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return conn
+
+    def release(self, conn):
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error:
+            healthy = False
+
+        with self._lock:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append(conn)
+
+        if not healthy:
+            self._discard(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def in_use(self):
+        with self._lock:
+            return self._in_use
+
+    def after_fork(self):
+        """
+        Forget the connections inherited from the parent process. They are
+        not closed, their sockets are still the parent's.
+        """
+
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._created_at = {}
+        self._in_use = 0
+
+    def close_all(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'opened': self._opened,
+                'closed': self._closed,
+                'recycled': self._recycled,
+                'ping_failures': self._ping_failures,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_time_total': round(self._wait_total, 6),
+                'wait_time_avg': round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+                'wait_time_max': round(self._wait_max, 6),
+            }
+
+    def _checkout(self):
+        # Newest idle connection first, the oldest ones age out on their own
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+            if conn is None:
+                return self._connect()
+
+            if self.recycle and time.monotonic() - self._created_at.get(id(conn), 0) > self.recycle:
+                with self._lock:
+                    self._recycled += 1
+                self._discard(conn)
+                continue
+
+            if self.pre_ping:
+                try:
+                    conn.ping(reconnect=False)
+                except mysql.connector.Error:
+                    with self._lock:
+                        self._ping_failures += 1
+                    self._discard(conn)
+                    continue
+
+            return conn
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.config)
+        if self.wrap is not None:
+            conn = self.wrap(conn)
+        with self._lock:
+            self._opened += 1
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._closed += 1
+            self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+
+class ReplicaSet:
+    """
+    Routes reads to the least loaded healthy replica pool, everything else
+    to the primary pool.
+
+    A background thread checks every replica each `check_interval` seconds
+    and takes it out of rotation while it cannot be reached, its
+    replication threads are stopped or it is more than `max_lag` seconds
+    behind. A replica whose checkout fails is also taken out until its next
+    successful check. With no healthy replica, reads go to the primary.
+    """
+
+    def __init__(self, primary, replicas, max_lag=10, check_interval=5):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._healthy = [False] * len(self.replicas)
+        self._lag = [None] * len(self.replicas)
+        self._next = 0
+        self._thread = None
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failovers = 0
+
+    def read_pool(self):
+        """Pool to read from, the primary when no replica is usable."""
+
+        self._ensure_thread()
+
+        with self._lock:
+            candidates = [i for i, healthy in enumerate(self._healthy) if healthy]
+            if not candidates:
+                self.primary_reads += 1
+                return self.primary
+
+            # Least connections in use, ties broken round-robin
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+
+        index = min(candidates, key=lambda i: (self.replicas[i].in_use(), (i - start) % len(self.replicas)))
+        with self._lock:
+            self.replica_reads += 1
+        return self.replicas[index]
+
+    def acquire_read(self):
+        """Check out a read connection, returns (pool, connection)."""
+
+        read_pool = self.read_pool()
+        if read_pool is self.primary:
+            return read_pool, read_pool.acquire()
+
+        try:
+            return read_pool, read_pool.acquire()
+        except (PoolTimeout, mysql.connector.Error) as error:
+            self._mark(self.replicas.index(read_pool), False, None)
+            with self._lock:
+                self.failovers += 1
+            logger.warning('Replica %s unavailable, reading from the primary: %s', read_pool.config.get('host'), error)
+            return self.primary, self.primary.acquire()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'replicas': [{
+                    'host': pool.config.get('host'),
+                    'port': pool.config.get('port'),
+                    'healthy': self._healthy[i],
+                    'lag': self._lag[i],
+                    'in_use': pool.in_use(),
+                } for i, pool in enumerate(self.replicas)],
+                'max_lag': self.max_lag,
+                'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+                'failovers': self.failovers,
+            }
+
+    def check(self):
+        for i, pool in enumerate(self.replicas):
+            try:
+                with pool.connection() as conn:
+                    lag = self._replication_lag(conn)
+            except (PoolTimeout, mysql.connector.Error) as error:
+                logger.warning('Replica %s failed its health check: %s', pool.config.get('host'), error)
+                self._mark(i, False, None)
+                continue
+
+            self._mark(i, lag is not None and lag <= self.max_lag, lag)
+
+    def _mark(self, index, healthy, lag):
+        with self._lock:
+            self._healthy[index] = healthy
+            self._lag[index] = lag
+
+    # Seconds behind the primary, None when replication is not running
+    def _replication_lag(self, conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute('SHOW REPLICA STATUS')
+            except mysql.connector.ProgrammingError:
+                # MySQL before 8.0.22 and MariaDB
+                cursor.execute('SHOW SLAVE STATUS')
+            status = cursor.fetchone()
+            # Drain the other channels of a multi-source replica
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+        if status is None:
+            return None
+        lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+        return int(lag) if lag is not None else None
+
+    def after_fork(self):
+        """Forget the replica connections and health thread of the parent process."""
+
+        for replica in self.replicas:
+            replica.after_fork()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Started on first use so the thread lives in the worker process
+    def _ensure_thread(self):
+        if self._thread is not None or not self.replicas:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='replica-check', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as error:
+                logger.warning('Replica health check failed: %s', error)
+            time.sleep(self.check_interval)
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Bounded buffer of the events waiting for one subscriber."""
+
+    def __init__(self, house_id, maxsize):
+        self.house_id = house_id
+        self.maxsize = maxsize
+        self.dropped = False
+
+        self._events = deque()
+        self._condition = threading.Condition()
+
+    def push(self, event):
+        with self._condition:
+            if len(self._events) >= self.maxsize:
+                # Too slow to keep up, the client reconnects with Last-Event-ID
+                self.dropped = True
+            else:
+                self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._events or self.dropped, timeout)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read by a coroutine, events pushed from any thread wake it on its event loop."""
+
+    def __init__(self, house_id, maxsize, loop):
+        super().__init__(house_id, maxsize)
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def push(self, event):
+        super().push(event)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The loop is closed, the worker is shutting down
+            pass
+
+    async def get(self, timeout):
+        while True:
+            self._ready.clear()
+            with self._condition:
+                if self._events:
+                    return self._events.popleft()
+                if self.dropped:
+                    return None
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+
+class EventHub:
+    """
+    In-process fan-out of newly created disparitions to per-house
+    subscribers.
+
+    Events are (disparition_id, encoded JSON) pairs: a disparition is
+    encoded once and the same string is pushed to every subscriber of its
+    house. Creations made by this worker are published right after their
+    commit, the ones made by other workers are picked up by a single poller
+    thread that queries the watched houses every `poll_interval` seconds,
+    each after the last id it saw of that house. Ids of a house are
+    allocated in commit order (see versions.py), so none is skipped.
+    The last `history_size` events of each house are kept to resume a
+    client from its Last-Event-ID without touching the database.
+    """
+
+    def __init__(self, pool, encode, buffer_size=100, history_size=200, poll_interval=2.0):
+        self.pool = pool
+        self.encode = encode
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._history = {}
+        self._poller = None
+        self._last_polled = {}
+
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, conn, house_id, last_event_id=None, subscription=None):
+        """
+        Register a subscriber, first filled with the events it missed since
+        `last_event_id`. `conn` is used to start the poller on the first
+        subscription and when the history of the house does not reach back
+        to `last_event_id`. `subscription` defaults to a new Subscription.
+        """
+
+        if subscription is None:
+            subscription = Subscription(str(house_id), self.buffer_size)
+
+        # The poller starts a house from what exists when its first client subscribes
+        with self._lock:
+            last_polled = self._last_polled.get(subscription.house_id)
+        if last_polled is None:
+            cursor = conn.cursor()
+            cursor.execute(repository.LAST_DISPARITION_OF_HOUSE_SQL, (house_id,))
+            last_polled = cursor.fetchone()[0]
+            cursor.close()
+
+        with self._lock:
+            history = list(self._history.get(subscription.house_id, ()))
+            self._subscribers.setdefault(subscription.house_id, set()).add(subscription)
+            self._last_polled.setdefault(subscription.house_id, last_polled)
+
+        if last_event_id is not None:
+            if history and history[0][0] <= last_event_id:
+                missed = [event for event in history if event[0] > last_event_id]
+            else:
+                cursor = conn.cursor()
+                cursor.execute(repository.DISPARITIONS_SINCE_SQL, (house_id, last_event_id, self.buffer_size))
+                missed = [(row[0], self.encode(repository.disparition_row(row))) for row in cursor.fetchall()]
+                cursor.close()
+
+            for event in missed:
+                subscription.push(event)
+
+        self._ensure_poller()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.house_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.house_id]
+                    self._last_polled.pop(subscription.house_id, None)
+            if subscription.dropped:
+                self.dropped += 1
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish_rows(self, rows):
+        """Publish rows selected with repository.DISPARITIONS_SELECT."""
+
+        for row in rows:
+            house_id = str(row[-1])
+
+            with self._lock:
+                history = self._history.setdefault(house_id, deque(maxlen=self.history_size))
+                # Rows of this worker are seen again by the poller
+                if any(event[0] == row[0] for event in history):
+                    continue
+
+                event = (row[0], self.encode(repository.disparition_row(row)))
+                history.append(event)
+                subscribers = list(self._subscribers.get(house_id, ()))
+                self.published += 1
+
+            for subscription in subscribers:
+                subscription.push(event)
+
+    def publish_created(self, conn, disparition_ids):
+        """Publish disparitions this worker just committed, one query whatever the audience."""
+
+        if not disparition_ids or not self.has_subscribers():
+            return
+
+        cursor = conn.cursor()
+        cursor.execute(
+            repository.DISPARITIONS_BY_ID_SQL % ', '.join(['%s'] * len(disparition_ids)),
+            list(disparition_ids)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+
+        self.publish_rows(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'houses': len(self._subscribers),
+                'subscribers': sum(len(subscribers) for subscribers in self._subscribers.values()),
+                'published': self.published,
+                'dropped': self.dropped,
+                'polling': self._poller is not None and self._poller.is_alive(),
+            }
+
+    def after_fork(self):
+        """Drop the subscribers and the poller of the parent process."""
+
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._last_polled = {}
+        self._poller = None
+
+    # Started with the first subscriber so the thread lives in the worker process
+    def _ensure_poller(self):
+        with self._lock:
+            if self._poller is not None:
+                return
+            self._poller = threading.Thread(target=self._poll, name='event-poller', daemon=True)
+            self._poller.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+
+            with self._lock:
+                last_polled = dict(self._last_polled)
+            if not last_polled:
+                continue
+
+            try:
+                with self.pool.connection() as conn:
+                    self._poll_once(conn, last_polled)
+            except Exception as error:
+                logger.warning('Event poller failed: %s', error)
+
+    # One statement for every watched house, each after its own last id
+    def _poll_once(self, conn, last_polled):
+        params = []
+        for house_id, last_id in last_polled.items():
+            params.extend((house_id, last_id, self.buffer_size))
+
+        sql = repository.DISPARITIONS_SINCE_SQL
+        if len(last_polled) > 1:
+            sql = ' UNION ALL '.join(['(' + sql + ')'] * len(last_polled))
+
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        if not rows:
+            return
+
+        with self._lock:
+            for row in rows:
+                house_id = str(row[-1])
+                if house_id in self._last_polled:
+                    self._last_polled[house_id] = max(self._last_polled[house_id], row[0])
+        self.publish_rows(rows)
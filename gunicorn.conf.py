@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import sys
+
+# SERVER_MODE=async serves asgi:app on uvicorn workers, the default is the
+# Flask app on gunicorn's own workers
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+# Threads of every worker holding a pooled connection besides the requests:
+# the retention job, the mirror refresh, the event poller and the
+# write-behind flusher
+BACKGROUND_CONNECTIONS = 4
+
+# The app is imported once in the master and forked, so the workers share
+# its modules and preloaded data copy-on-write. app.post_fork() gives each
+# worker its own connections and threads. GUNICORN_PRELOAD=0 imports it in
+# every worker instead
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if SERVER_MODE == 'async':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    workers = int(os.environ.get('WEB_CONCURRENCY', CPU_COUNT))
+else:
+    wsgi_app = 'app:create_app()'
+
+    # gthread: a thread pool per worker, the default. gevent: greenlets,
+    # sync: one request at a time per worker
+    worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+    if worker_class == 'gevent':
+        # Patched before the app is preloaded, so the locks and sockets it
+        # creates in the master are the cooperative ones
+        from gevent import monkey
+        monkey.patch_all()
+
+        worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+        workers = int(os.environ.get('WEB_CONCURRENCY', CPU_COUNT))
+        # The C extension of mysql-connector would block the whole worker
+        os.environ.setdefault('DB_USE_PURE', '1')
+    else:
+        threads = int(os.environ.get('GUNICORN_THREADS', 4 if worker_class == 'gthread' else 1))
+        workers = int(os.environ.get('WEB_CONCURRENCY', CPU_COUNT * 2 + 1))
+        # A connection per request thread plus one per background thread, so
+        # a retention pass or a flush does not leave a request thread waiting
+        # for the pool. Connections held for a whole streamed response can
+        # still make others wait up to DB_POOL_TIMEOUT
+        os.environ.setdefault('DB_POOL_SIZE', str(threads + BACKGROUND_CONNECTIONS))
+
+
+def post_fork(server, worker):
+    # Only a preloaded app is imported before the fork
+    module = sys.modules.get('app')
+    if module is not None:
+        module.post_fork()
@@ -0,0 +1,162 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes of the image formats the store recognises
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+# Path of the image route, stored in disparition_image_overview instead of the data
+URL_PREFIX = '/api/v1/get_image/'
+
+
+def sniff(data):
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def decode(value):
+    """Image bytes of a base64 string or data: URL, None for anything else."""
+
+    if not isinstance(value, str) or not value:
+        return None
+
+    if value.startswith('data:'):
+        header, _, value = value.partition(',')
+        if not header.endswith(';base64'):
+            return None
+
+    try:
+        data = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+    return data if sniff(data) is not None else None
+
+
+class ImageStore:
+    """
+    Content-addressed image files under `root`.
+
+    An image is stored once under the SHA-256 of its bytes, in two levels of
+    sub-directories, so its name never changes meaning and can be cached
+    forever. Files are written to a temporary name and renamed, readers
+    never see a partial image.
+
+    Images no disparition references any more are deleted with the last
+    disparition using them (see on_delete). A file written or reused less
+    than `grace` seconds ago is kept, the disparition about to reference it
+    may not be committed yet.
+    """
+
+    def __init__(self, root, grace=300):
+        self.root = root
+        self.grace = grace
+
+    def path(self, digest):
+        if not DIGEST.match(digest):
+            return None
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+
+        if os.path.exists(path):
+            try:
+                # Reused, protected from removal for another grace period
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+        return digest
+
+    def externalize(self, value):
+        """Store an inline image and return its URL, other values are returned unchanged."""
+
+        data = decode(value)
+        if data is None:
+            return value
+        return URL_PREFIX + self.put(data)
+
+    def mimetype(self, path):
+        with open(path, 'rb') as f:
+            return sniff(f.read(12)) or 'application/octet-stream'
+
+    def digest(self, value):
+        """Digest of an image URL of the store, None for any other value."""
+
+        if isinstance(value, str) and value.startswith(URL_PREFIX):
+            digest = value[len(URL_PREFIX):]
+            if DIGEST.match(digest):
+                return digest
+        return None
+
+    def remove(self, digest):
+        path = self.path(digest)
+        try:
+            if time.time() - os.path.getmtime(path) >= self.grace:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            logger.warning('Removing image %s failed: %s', digest, error)
+
+    def on_delete(self, cursor, rows):
+        """
+        purge.delete_disparitions hook, `rows` are (disparition_id, house_id)
+        pairs. Reads the images of the disparitions about to be deleted and
+        returns the callable removing, once the batch is committed, those no
+        other disparition references.
+        """
+
+        ids = [row[0] for row in rows]
+        cursor.execute(
+            'SELECT DISTINCT disparition_image_overview FROM disparition '
+            'WHERE disparition_id IN (%s) AND disparition_image_overview LIKE %%s' % ', '.join(['%s'] * len(ids)),
+            ids + [URL_PREFIX + '%']
+        )
+        urls = [row[0] for row in cursor.fetchall() if self.digest(row[0]) is not None]
+        if not urls:
+            return None
+
+        def release(cursor):
+            cursor.execute(
+                'SELECT DISTINCT disparition_image_overview FROM disparition '
+                'WHERE disparition_image_overview IN (%s)' % ', '.join(['%s'] * len(urls)),
+                urls
+            )
+            referenced = {row[0] for row in cursor.fetchall()}
+            for url in urls:
+                if url not in referenced:
+                    self.remove(self.digest(url))
+
+        return release
@@ -0,0 +1,152 @@
+import datetime
+import os
+
+import rollups
+import schema
+import versions
+
+DISPARITION_FIELDS = (
+    'disparition_date',
+    'disparition_object_stolen',
+    'disparition_image_overview',
+    'disparition_object',
+    'camera_id',
+    'room_id',
+)
+
+# Positions of the image and the room in the disparition parameters
+IMAGE_INDEX = DISPARITION_FIELDS.index('disparition_image_overview')
+ROOM_INDEX = DISPARITION_FIELDS.index('room_id')
+
+VIDEO_FIELDS = (
+    'video_date',
+    'video_length',
+    'video_link',
+)
+
+INSERT_DISPARITION_SQL = (
+    'INSERT INTO disparition (disparition_date, disparition_object_stolen, disparition_image_overview, '
+    'disparition_object, camera_id, room_id) VALUES (%s, %s, %s, %s, %s, %s)'
+)
+
+INSERT_VIDEO_SQL = 'INSERT INTO video (video_date, video_length, video_link, disparition_id) VALUES (%s, %s, %s, %s)'
+
+CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+
+
+# Id fields and whether they may be null, the camera of a disparition is optional
+ID_FIELDS = (('room_id', False), ('camera_id', True))
+DATE_FIELDS = ('disparition_date', 'video_date')
+
+
+class InvalidRecord(ValueError):
+    """Raised when a disparition payload is not an object, or has missing or invalid fields."""
+
+
+# An int, or the string of one, as MySQL accepts both. None when invalid
+def _parse_id(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def _is_date(value):
+    if not isinstance(value, str):
+        return False
+    try:
+        datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_record(payload, image_store=None):
+    """
+    Split a create_disparition payload into disparition and video parameters.
+    Ids are converted to int and dates checked, so a bad record is reported
+    on its own instead of failing the transaction of its batch. An inline
+    image is written to `image_store` and replaced by its URL.
+    """
+
+    if not isinstance(payload, dict):
+        raise InvalidRecord('Record must be a JSON object')
+
+    missing = [field for field in DISPARITION_FIELDS + VIDEO_FIELDS if field not in payload]
+    if missing:
+        raise InvalidRecord('Missing fields: ' + ', '.join(missing))
+
+    values = dict(payload)
+    invalid = []
+    for field, nullable in ID_FIELDS:
+        if values[field] is None and nullable:
+            continue
+        values[field] = _parse_id(values[field])
+        if values[field] is None:
+            invalid.append(field)
+    invalid.extend(field for field in DATE_FIELDS if not _is_date(values[field]))
+    if invalid:
+        raise InvalidRecord('Invalid fields: ' + ', '.join(invalid))
+
+    disparition = [values[field] for field in DISPARITION_FIELDS]
+    if image_store is not None:
+        disparition[IMAGE_INDEX] = image_store.externalize(disparition[IMAGE_INDEX])
+    disparition = tuple(disparition)
+    video = tuple(values[field] for field in VIDEO_FIELDS)
+
+    return disparition, video
+
+
+def insert_disparitions(conn, records, chunk_size=CHUNK_SIZE):
+    """
+    Insert (disparition, video) records in a single transaction.
+
+    Each chunk is sent as one multi-row INSERT per table. MySQL hands out
+    consecutive auto-increment values to a multi-row INSERT, so the id of
+    every row is derived from lastrowid and auto_increment_increment, which
+    is how each video gets linked to its disparition. The disparition
+    version of every house touched is bumped first, which orders the ids of
+    a house by commit, and the daily rollups are updated in the same
+    transaction.
+    Returns the list of (disparition_id, video_id) in the order of
+    `records`.
+    """
+
+    ids = []
+
+    schema.ensure(conn)
+    cursor = conn.cursor()
+
+    try:
+        # Room ids may come as numbers or numeric strings, MySQL takes both
+        versions.bump_houses_of_rooms(cursor, sorted({int(disparition[ROOM_INDEX]) for disparition, video in records}))
+
+        cursor.execute('SELECT @@session.auto_increment_increment')
+        step = cursor.fetchone()[0]
+
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+
+            cursor.executemany(INSERT_DISPARITION_SQL, [disparition for disparition, video in chunk])
+            disparition_ids = [cursor.lastrowid + i * step for i in range(len(chunk))]
+
+            cursor.executemany(
+                INSERT_VIDEO_SQL,
+                [video + (disparition_id,) for (disparition, video), disparition_id in zip(chunk, disparition_ids)]
+            )
+            video_ids = [cursor.lastrowid + i * step for i in range(len(chunk))]
+
+            ids.extend(zip(disparition_ids, video_ids))
+            rollups.add(cursor, disparition_ids)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return ids
@@ -0,0 +1,84 @@
+import datetime
+import decimal
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Keyword arguments of json.dumps orjson can honour, any other one falls back
+# to the standard library
+_ORJSON_KWARGS = {'indent', 'sort_keys', 'separators', 'ensure_ascii'}
+
+
+def _default(value):
+    # Same strings as the str() the routes used to apply by hand
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta, decimal.Decimal)):
+        return str(value)
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+
+class RowSchema:
+    """
+    Formatter turning a row tuple into the JSON object of an endpoint.
+
+    Columns are (key, index) or (key, index, str) pairs, the latter for
+    values sent as their str(), such as DATETIME and TIME columns. Keys are
+    kept in sorted order, the order the encoder sorts them in anyway.
+    """
+
+    def __init__(self, *columns):
+        self.columns = tuple(sorted(columns))
+        fields = tuple((column[0], column[1], str if len(column) > 2 else None) for column in self.columns)
+
+        def format(row):
+            return {key: row[index] if convert is None else convert(row[index]) for key, index, convert in fields}
+
+        self._format = format
+
+    def __call__(self, row):
+        return self._format(row)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider encoding with orjson when it is installed, with the
+    standard library otherwise.
+
+    Dates, times, timedeltas and decimals are encoded as their str() in both
+    cases. orjson writes UTF-8 instead of \\u escapes, keys are still sorted
+    by default.
+    """
+
+    default = staticmethod(_default)
+
+    def encode(self, obj, **kwargs):
+        """Encode `obj` to bytes, dumps() is the str version of this."""
+
+        if orjson is None or not _ORJSON_KWARGS.issuperset(kwargs):
+            return super().dumps(obj, **kwargs).encode()
+
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(obj, default=_default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        return self.encode(obj, **kwargs).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        dump_args = {}
+
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            dump_args['indent'] = 2
+        else:
+            dump_args['separators'] = (',', ':')
+
+        # Straight from the encoder's bytes, no str round trip
+        return self._app.response_class(self.encode(obj, **dump_args) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,275 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from flask import g, has_app_context
+
+from jsonprovider import FastJSONProvider
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, +Inf is implied
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class RequestMetrics:
+    """Query count, DB time, rows fetched and serialisation time of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.serialize_time = 0.0
+        self.pool_wait = 0.0
+        self.status = None
+
+    def server_timing(self):
+        return ', '.join([
+            'db;dur=%.3f;desc="%d queries"' % (self.db_time * 1000, self.queries),
+            'pool;dur=%.3f' % (self.pool_wait * 1000),
+            'serialize;dur=%.3f' % (self.serialize_time * 1000),
+            'total;dur=%.3f' % ((time.perf_counter() - self.started) * 1000),
+        ])
+
+
+class BootTimes:
+    """
+    Boot latency of the worker: seconds from `started`, a perf_counter()
+    taken before the app's imports, until the app module was imported and
+    until its first request arrived.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.imported = None
+        self.first_request = None
+
+    def mark_imported(self):
+        self.imported = time.perf_counter() - self.started
+        logger.info('App imported in %.3fs', self.imported)
+
+    def mark_first_request(self):
+        if self.first_request is None:
+            self.first_request = time.perf_counter() - self.started
+            logger.info('First request %.3fs after the app started importing', self.first_request)
+
+    def stats(self):
+        return {
+            'import_seconds': self.imported,
+            'first_request_seconds': self.first_request,
+        }
+
+
+# Metrics of the native ASGI request being served, see asgi.native
+native_request = contextvars.ContextVar('native_request', default=None)
+
+
+# Metrics of the request being served, None outside of a request
+def current():
+    if has_app_context():
+        return g.get('request_metrics')
+    return native_request.get()
+
+
+class InstrumentedCursor:
+    """Cursor proxy adding its executions and fetched rows to the current request."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def execute(self, *args, **kwargs):
+        return self._timed(True, 0, self._cursor.execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._timed(True, 0, self._cursor.executemany, *args, **kwargs)
+
+    def fetchone(self):
+        return self._timed(False, 1, self._cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(False, None, self._cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._timed(False, None, self._cursor.fetchall)
+
+    def _timed(self, query, rows, method, *args, **kwargs):
+        metrics = current()
+        if metrics is None:
+            return method(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            metrics.db_time += time.perf_counter() - start
+
+        if query:
+            metrics.queries += 1
+        elif result:
+            metrics.rows += rows if rows is not None else len(result)
+        return result
+
+
+class InstrumentedConnection:
+    """
+    Connection proxy whose cursors are instrumented. The pool keeps the
+    proxy, so per-connection state such as prepared statements stays keyed
+    on one object for the whole life of the connection.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+
+class TimedJSONProvider(FastJSONProvider):
+    """JSON provider adding its encoding time to the current request."""
+
+    def encode(self, obj, **kwargs):
+        metrics = current()
+        if metrics is None:
+            return super().encode(obj, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return super().encode(obj, **kwargs)
+        finally:
+            metrics.serialize_time += time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Per-route histograms of the requests served by this worker, rendered
+    in the Prometheus text format.
+
+    Every gunicorn worker keeps its own registry, so the pid label tells
+    apart the workers a scraper reaches through the same address. A request
+    running more than `query_budget` queries is logged as a warning, which
+    is how N+1 query loops show up; a budget of 0 disables the check.
+    """
+
+    HISTOGRAMS = (
+        ('request_duration_seconds', 'Time from the start of the request to its teardown', TIME_BUCKETS),
+        ('request_db_seconds', 'Time spent executing queries and fetching rows', TIME_BUCKETS),
+        ('request_pool_wait_seconds', 'Time spent checking a connection out of the pool', TIME_BUCKETS),
+        ('request_serialize_seconds', 'Time spent encoding JSON', TIME_BUCKETS),
+        ('request_queries', 'Queries executed', COUNT_BUCKETS),
+        ('request_rows', 'Rows fetched', ROWS_BUCKETS),
+    )
+
+    def __init__(self, prefix='objura', query_budget=20):
+        self.prefix = prefix
+        self.query_budget = query_budget
+
+        self._lock = threading.Lock()
+        self._histograms = {name: {} for name, help, buckets in self.HISTOGRAMS}
+        self._requests = {}
+        self._over_budget = {}
+
+    def observe(self, route, metrics):
+        values = {
+            'request_duration_seconds': time.perf_counter() - metrics.started,
+            'request_db_seconds': metrics.db_time,
+            'request_pool_wait_seconds': metrics.pool_wait,
+            'request_serialize_seconds': metrics.serialize_time,
+            'request_queries': metrics.queries,
+            'request_rows': metrics.rows,
+        }
+        over_budget = self.query_budget and metrics.queries > self.query_budget
+
+        with self._lock:
+            for name, help, buckets in self.HISTOGRAMS:
+                histogram = self._histograms[name].get(route)
+                if histogram is None:
+                    histogram = self._histograms[name][route] = Histogram(buckets)
+                histogram.observe(values[name])
+
+            key = (route, str(metrics.status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if over_budget:
+                self._over_budget[route] = self._over_budget.get(route, 0) + 1
+
+        if over_budget:
+            logger.warning(
+                'Query budget exceeded on %s: %d queries for a budget of %d',
+                route, metrics.queries, self.query_budget
+            )
+
+    def render(self, pid, gauges):
+        """
+        Text exposition of the histograms and counters, followed by
+        `gauges`, a list of (name, help, [(labels, value)]).
+        """
+
+        lines = []
+        pid_label = 'pid="%d"' % pid
+
+        with self._lock:
+            for name, help, buckets in self.HISTOGRAMS:
+                metric = '%s_%s' % (self.prefix, name)
+                lines.append('# HELP %s %s' % (metric, help))
+                lines.append('# TYPE %s histogram' % metric)
+
+                for route, histogram in sorted(self._histograms[name].items()):
+                    labels = '%s,route="%s"' % (pid_label, route)
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, bound, cumulative))
+                    lines.append('%s_sum{%s} %s' % (metric, labels, _number(histogram.total)))
+                    lines.append('%s_count{%s} %d' % (metric, labels, histogram.count))
+
+            metric = '%s_requests_total' % self.prefix
+            lines.append('# HELP %s Requests served' % metric)
+            lines.append('# TYPE %s counter' % metric)
+            for (route, status), count in sorted(self._requests.items()):
+                lines.append('%s{%s,route="%s",status="%s"} %d' % (metric, pid_label, route, status, count))
+
+            metric = '%s_query_budget_exceeded_total' % self.prefix
+            lines.append('# HELP %s Requests that ran more queries than the budget of %d' % (metric, self.query_budget))
+            lines.append('# TYPE %s counter' % metric)
+            for route, count in sorted(self._over_budget.items()):
+                lines.append('%s{%s,route="%s"} %d' % (metric, pid_label, route, count))
+
+        for name, help, samples in gauges:
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s gauge' % metric)
+            for labels, value in samples:
+                labels = ','.join([pid_label] + ['%s="%s"' % item for item in sorted(labels.items())])
+                lines.append('%s{%s} %s' % (metric, labels, _number(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
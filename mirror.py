@@ -0,0 +1,263 @@
+import logging
+import threading
+import time
+from bisect import bisect_right
+
+import pagination
+import repository
+import schema
+import versions
+
+logger = logging.getLogger(__name__)
+
+# Mirrored tables, user without its password
+TABLES = {
+    'house': 'SELECT house_id, house_name FROM house ORDER BY house_id',
+    'room': 'SELECT room_id, room_name, house_id FROM room ORDER BY room_id',
+    'camera': 'SELECT camera_id, camera_name, house_id FROM camera ORDER BY camera_id',
+    'can_consult': 'SELECT user_id, house_id FROM can_consult ORDER BY user_id, house_id',
+    'user': 'SELECT user_id, user_email, user_firstname, user_lastname FROM user ORDER BY user_id',
+}
+
+# Version scopes the mirror can answer ETags for, see versions.py
+SCOPES = ('house', 'room', 'camera')
+
+
+class Snapshot:
+    """Rows of the mirrored tables read in one transaction, indexed for the routes."""
+
+    def __init__(self, rows, scope_versions, loaded_at):
+        self.versions = scope_versions
+        self.loaded_at = loaded_at
+
+        self.houses = rows['house']
+        self.house_keys = [(row[0],) for row in self.houses]
+        self.rooms = rows['room']
+        self.room_keys = [(row[0],) for row in self.rooms]
+
+        house_names = {row[0]: row[1] for row in self.houses}
+        users = {row[0]: row for row in rows['user']}
+
+        self.rooms_by_house = {}
+        for room_id, room_name, house_id in self.rooms:
+            self.rooms_by_house.setdefault(str(house_id), []).append((room_id, room_name))
+
+        self.cameras_by_house = {}
+        for camera_id, camera_name, house_id in rows['camera']:
+            self.cameras_by_house.setdefault(str(house_id), []).append((camera_id, camera_name))
+
+        # Same rows as repository.CAN_CONSULT_SQL, the joins drop unknown users and houses
+        self.can_consult = [
+            (user_id, users[user_id][2], users[user_id][3], house_id, house_names[house_id])
+            for user_id, house_id in rows['can_consult']
+            if user_id in users and house_id in house_names
+        ]
+        self.can_consult_keys = [(row[0], row[3]) for row in self.can_consult]
+
+        # Same rows as repository.HOUSES_OF_USER_SQL, which does not join user
+        self.houses_by_user = {}
+        for user_id, house_id in rows['can_consult']:
+            if house_id in house_names:
+                self.houses_by_user.setdefault(str(user_id), []).append((house_id, house_names[house_id]))
+
+        self.sizes = {table: len(table_rows) for table, table_rows in rows.items()}
+
+
+def _page(rows, keys, formatter, limit, after):
+    start = 0
+    if after is not None:
+        try:
+            start = bisect_right(keys, tuple(after))
+        except TypeError:
+            raise pagination.InvalidPageArgs('Invalid cursor')
+
+    more = start + limit < len(rows)
+    return [formatter(row) for row in rows[start:start + limit]], keys[start + limit - 1] if more else None
+
+
+class Mirror:
+    """
+    Local copy of house, room, camera, can_consult and user, so the routes
+    reading them do not pay a round trip to the database server.
+
+    A background thread of the worker reloads every table, together with
+    the versions of their scopes, in one consistent-snapshot transaction
+    every `refresh_interval` seconds. Readers get None, and fall back to
+    MySQL, while the mirror is older than `max_staleness` seconds, before
+    its first load, and between an `invalidate()` and the reload it
+    triggers, which write routes call so their own changes are read back.
+    """
+
+    def __init__(self, pool, refresh_interval=30, max_staleness=120):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._snapshot = None
+
+        self._version = 0
+        self._built_version = None
+
+        self.refreshes = 0
+        self.failures = 0
+        self.hits = 0
+        self.fallbacks = 0
+
+    def houses(self):
+        snapshot = self._fresh()
+        return None if snapshot is None else [repository.house_row(row) for row in snapshot.houses]
+
+    def page_houses(self, limit, after):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return _page(snapshot.houses, snapshot.house_keys, repository.house_row, limit, after)
+
+    def rooms(self):
+        snapshot = self._fresh()
+        return None if snapshot is None else [repository.room_with_house_row(row) for row in snapshot.rooms]
+
+    def page_rooms(self, limit, after):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return _page(snapshot.rooms, snapshot.room_keys, repository.room_with_house_row, limit, after)
+
+    def houses_of_user(self, user_id):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return [repository.house_row(row) for row in snapshot.houses_by_user.get(str(user_id), ())]
+
+    def rooms_of_house(self, house_id):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return [repository.room_row(row) for row in snapshot.rooms_by_house.get(str(house_id), ())]
+
+    def cameras_of_house(self, house_id):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return [repository.camera_row(row) for row in snapshot.cameras_by_house.get(str(house_id), ())]
+
+    def can_consult(self):
+        snapshot = self._fresh()
+        return None if snapshot is None else [repository.can_consult_row(row) for row in snapshot.can_consult]
+
+    def page_can_consult(self, limit, after):
+        snapshot = self._fresh()
+        if snapshot is None:
+            return None
+        return _page(snapshot.can_consult, snapshot.can_consult_keys, repository.can_consult_row, limit, after)
+
+    def versions(self, scopes):
+        """Versions of `scopes` as of the mirrored rows, None unless all of them are mirrored."""
+
+        if any(scope not in SCOPES for scope in scopes) or not schema.tracked(scopes):
+            return None
+        snapshot = self._fresh(count=False)
+        return None if snapshot is None else [snapshot.versions.get(scope, 0) for scope in scopes]
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+        self._wake.set()
+
+    def refresh(self):
+        with self._lock:
+            version = self._version
+        # Staleness counts from the snapshot, not from the end of the load
+        started = time.monotonic()
+
+        with self.pool.connection() as conn:
+            schema.ensure(conn)
+            conn.start_transaction(consistent_snapshot=True, readonly=True)
+            cursor = conn.cursor()
+            try:
+                cursor.execute(versions.read_sql(SCOPES), list(SCOPES))
+                scope_versions = dict(cursor.fetchall())
+
+                rows = {}
+                for table, sql in TABLES.items():
+                    cursor.execute(sql)
+                    rows[table] = cursor.fetchall()
+            finally:
+                cursor.close()
+                conn.rollback()
+
+        snapshot = Snapshot(rows, scope_versions, started)
+
+        with self._lock:
+            self._snapshot = snapshot
+            self._built_version = version
+            self.refreshes += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'age_seconds': round(time.monotonic() - snapshot.loaded_at, 3) if snapshot is not None else None,
+                'refresh_interval': self.refresh_interval,
+                'max_staleness': self.max_staleness,
+                'dirty': self._built_version != self._version,
+                'rows': snapshot.sizes if snapshot is not None else {},
+                'versions': snapshot.versions if snapshot is not None else {},
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'hits': self.hits,
+                'fallbacks': self.fallbacks,
+            }
+
+    def _fresh(self, count=True):
+        self._ensure_thread()
+
+        with self._lock:
+            snapshot = self._snapshot
+            usable = (
+                snapshot is not None
+                and self._built_version == self._version
+                and time.monotonic() - snapshot.loaded_at <= self.max_staleness
+            )
+            if count:
+                if usable:
+                    self.hits += 1
+                else:
+                    self.fallbacks += 1
+
+        return snapshot if usable else None
+
+    def after_fork(self):
+        """
+        Drop the refresh thread of the parent process, the snapshot it
+        loaded is kept and shared with it until the next refresh.
+        """
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    # Started on first use so the thread lives in the worker process
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='mirror-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as error:
+                with self._lock:
+                    self.failures += 1
+                logger.warning('Mirror refresh failed: %s', error)
+            self._wake.wait(self.refresh_interval)
@@ -0,0 +1,94 @@
+import base64
+import json
+
+from flask import request
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class InvalidPageArgs(ValueError):
+    """Raised when the limit or after query parameters cannot be used."""
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        key = json.loads(raw)
+    except ValueError:
+        raise InvalidPageArgs('Invalid cursor')
+
+    if not isinstance(key, list) or len(key) != size:
+        raise InvalidPageArgs('Invalid cursor')
+
+    return key
+
+
+# A list endpoint switches to paginated output as soon as one of these is given
+def requested(args=None):
+    args = request.args if args is None else args
+    return 'limit' in args or 'after' in args
+
+
+def page_args(key_size, args=None):
+    args = request.args if args is None else args
+
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise InvalidPageArgs('limit must be an integer')
+
+    if limit < 1 or limit > MAX_LIMIT:
+        raise InvalidPageArgs('limit must be between 1 and %d' % MAX_LIMIT)
+
+    after = args.get('after')
+    if after:
+        after = decode_cursor(after, key_size)
+    else:
+        after = None
+
+    return limit, after
+
+
+# (a, b) > (x, y) written out so MySQL can range-scan the index on (a, b)
+def keyset_condition(columns, values):
+    clauses = []
+    params = []
+
+    for i, column in enumerate(columns):
+        equal = ['%s = %%s' % previous for previous in columns[:i]]
+        clauses.append('(' + ' AND '.join(equal + ['%s > %%s' % column]) + ')')
+        params.extend(values[:i])
+        params.append(values[i])
+
+    return '(' + ' OR '.join(clauses) + ')', params
+
+
+def page_query(select, order_by, limit, after, conditions=(), params=()):
+    conditions = list(conditions)
+    params = list(params)
+
+    if after is not None:
+        clause, clause_params = keyset_condition(order_by, after)
+        conditions.append(clause)
+        params.extend(clause_params)
+
+    sql = select
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY ' + ', '.join(order_by) + ' LIMIT %s'
+    params.append(limit + 1)
+
+    return sql, params
+
+
+def fetch_page(cursor, select, order_by, limit, after, conditions=(), params=()):
+    cursor.execute(*page_query(select, order_by, limit, after, conditions, params))
+    rows = cursor.fetchall()
+
+    return rows[:limit], len(rows) > limit
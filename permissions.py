@@ -0,0 +1,205 @@
+import threading
+import time
+from bisect import bisect_right
+
+import pagination
+import repository
+import statements
+import versions
+
+# Tables the index is made of, their api_version counters tell it is stale
+SCOPES = ['can_consult', 'house', 'user']
+
+
+class PermissionIndex:
+    """
+    In-memory copy of can_consult joined with user and house names.
+
+    The whole table is loaded in one query and kept for `ttl` seconds or
+    until `invalidate()` bumps the version. At most every `check_interval`
+    seconds a reader also compares the api_version counters of SCOPES,
+    bumped by triggers on every write, with the ones of the loaded index
+    and reloads it when they moved. Without the triggers only the TTL
+    expires it. Invalidating a single user only reloads that user's houses
+    the next time they are asked for. Readers pass a `connect` callable
+    that is only called when the index has to go to the database.
+    """
+
+    def __init__(self, ttl=300, check_interval=5):
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+        self._rows = []
+        self._keys = []
+        self._by_user = {}
+        self._dirty_users = set()
+
+        self._version = 0
+        self._built_version = None
+        self._built_at = None
+        self._built_counters = None
+        self._checked_at = None
+
+        self.builds = 0
+        self.user_refreshes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def houses_of_user(self, connect, user_id):
+        loaded = self._ensure(connect)
+        key = str(user_id)
+
+        with self._lock:
+            dirty = key in self._dirty_users
+            houses = self._by_user.get(key, [])
+            if not dirty and not loaded:
+                self.hits += 1
+
+        if dirty:
+            houses = self._refresh_user(connect, key)
+
+        return [repository.house_row(house) for house in houses]
+
+    def can_consult(self, connect):
+        loaded = self._ensure(connect, include_dirty=True)
+
+        with self._lock:
+            if not loaded:
+                self.hits += 1
+            rows = self._rows
+
+        return [repository.can_consult_row(row) for row in rows]
+
+    def page_can_consult(self, connect, limit, after):
+        loaded = self._ensure(connect, include_dirty=True)
+
+        with self._lock:
+            if not loaded:
+                self.hits += 1
+            rows, keys = self._rows, self._keys
+
+        start = 0
+        if after is not None:
+            try:
+                start = bisect_right(keys, tuple(after))
+            except TypeError:
+                raise pagination.InvalidPageArgs('Invalid cursor')
+
+        page = rows[start:start + limit]
+        more = start + limit < len(rows)
+
+        return [repository.can_consult_row(row) for row in page], keys[start + limit - 1] if more else None
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._version += 1
+            else:
+                self._dirty_users.add(str(user_id))
+
+    def rebuild(self, connect):
+        with self._build_lock:
+            self._load(connect)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._by_user),
+                'entries': len(self._rows),
+                'version': self._version,
+                'built_version': self._built_version,
+                'age_seconds': round(time.monotonic() - self._built_at, 3) if self._built_at is not None else None,
+                'ttl': self.ttl,
+                'check_interval': self.check_interval,
+                'counters': self._built_counters,
+                'dirty_users': len(self._dirty_users),
+                'builds': self.builds,
+                'user_refreshes': self.user_refreshes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _stale(self, include_dirty):
+        if self._built_version != self._version:
+            return True
+        if self.ttl and time.monotonic() - self._built_at > self.ttl:
+            return True
+        return include_dirty and bool(self._dirty_users)
+
+    # One reader per check_interval compares the counters, the others go on
+    def _check_counters(self, connect):
+        now = time.monotonic()
+        with self._lock:
+            if self._built_at is None or now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            built = self._built_counters
+
+        counters = versions.read(connect(), SCOPES)
+        if counters is not None and counters != built:
+            self.invalidate()
+
+    # Returns True when the call was counted as a miss
+    def _ensure(self, connect, include_dirty=False):
+        if self.check_interval:
+            self._check_counters(connect)
+
+        with self._lock:
+            stale = self._stale(include_dirty)
+            if stale:
+                self.misses += 1
+
+        if stale:
+            # Concurrent readers wait for a single rebuild instead of running their own
+            with self._build_lock:
+                with self._lock:
+                    stale = self._stale(include_dirty)
+                if stale:
+                    self._load(connect)
+            return True
+
+        return False
+
+    def _load(self, connect):
+        with self._lock:
+            version = self._version
+
+        # Read before the rows, a write during the load shows at the next check
+        counters = versions.read(connect(), SCOPES)
+
+        cursor = connect().cursor()
+        cursor.execute(repository.CAN_CONSULT_SQL)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(str(row[0]), []).append((row[3], row[4]))
+
+        with self._lock:
+            self._rows = rows
+            self._keys = [(row[0], row[3]) for row in rows]
+            self._by_user = by_user
+            self._dirty_users = set()
+            self._built_version = version
+            self._built_at = time.monotonic()
+            self._built_counters = counters
+            self._checked_at = self._built_at
+            self.builds += 1
+
+    def _refresh_user(self, connect, key):
+        houses = statements.run(connect(), 'houses_of_user', (key,))
+
+        with self._lock:
+            if houses:
+                self._by_user[key] = houses
+            else:
+                self._by_user.pop(key, None)
+            self._dirty_users.discard(key)
+            self.user_refreshes += 1
+            self.misses += 1
+
+        return houses
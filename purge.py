@@ -0,0 +1,345 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import schema
+import versions
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 1000))
+
+# Held by the worker running a retention pass, the others skip theirs
+RETENTION_LOCK = 'objura_retention'
+
+
+class Scope:
+    """
+    Disparitions selected for deletion: any combination of a house, a room,
+    a [since, until) date range and houses to leave out. An empty scope
+    selects every disparition.
+    """
+
+    def __init__(self, house_id=None, room_id=None, since=None, until=None, exclude_houses=()):
+        self.house_id = house_id
+        self.room_id = room_id
+        self.since = since
+        self.until = until
+        self.exclude_houses = list(exclude_houses)
+
+    def is_empty(self):
+        return (
+            self.house_id is None and self.room_id is None and self.since is None and self.until is None
+            and not self.exclude_houses
+        )
+
+    def conditions(self):
+        conditions = []
+        params = []
+
+        if self.house_id is not None:
+            conditions.append('r.house_id = %s')
+            params.append(self.house_id)
+        if self.room_id is not None:
+            conditions.append('d.room_id = %s')
+            params.append(self.room_id)
+        if self.since is not None:
+            conditions.append('d.disparition_date >= %s')
+            params.append(self.since)
+        if self.until is not None:
+            conditions.append('d.disparition_date < %s')
+            params.append(self.until)
+        if self.exclude_houses:
+            # Disparitions whose room is gone belong to no house, so to none left out
+            conditions.append(
+                '(r.house_id IS NULL OR r.house_id NOT IN (%s))' % ', '.join(['%s'] * len(self.exclude_houses))
+            )
+            params.extend(self.exclude_houses)
+
+        return conditions, params
+
+
+def delete_disparitions(conn, scope, batch_size=BATCH_SIZE, pause=0.0, on_delete=None):
+    """
+    Delete the disparitions of `scope` and their videos, in batches of at
+    most `batch_size` primary keys.
+
+    Each batch is its own short transaction: the videos and disparitions are
+    deleted, tombstones recorded for delta clients and the disparition
+    version of every house touched bumped, so readers never see a half
+    deleted batch and ingestion is only blocked for one batch at a time.
+    `on_delete(cursor, rows)` runs inside that transaction with the
+    (disparition_id, house_id) pairs being deleted, house_id being None for
+    disparitions whose room no longer exists. A callable it returns is
+    called with the cursor once the batch is committed. `pause` seconds are
+    slept between batches to throttle the purge. An empty scope also
+    deletes the videos not linked to any disparition, as the full purge
+    always did. Returns the number of disparitions deleted.
+    """
+
+    schema.ensure(conn)
+
+    conditions, params = scope.conditions()
+    # LEFT JOIN: the room only gives the house, a disparition whose room row
+    # is missing is still deleted
+    select = (
+        'SELECT d.disparition_id, r.house_id FROM disparition d LEFT JOIN room r ON r.room_id = d.room_id WHERE '
+        + ' AND '.join(conditions + ['d.disparition_id > %s'])
+        + ' ORDER BY d.disparition_id LIMIT %s'
+    )
+
+    deleted = 0
+    last_id = 0
+    cursor = conn.cursor()
+
+    try:
+        while True:
+            cursor.execute(select, params + [last_id, batch_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            ids = [row[0] for row in rows]
+            placeholders = ', '.join(['%s'] * len(ids))
+            # Without a house, no client ever saw the disparition
+            housed = [row for row in rows if row[1] is not None]
+
+            # Bumped first so the tombstone ids of a house follow commit order
+            if housed:
+                versions.bump(cursor, ['disparition:%s' % house_id for house_id in {row[1] for row in housed}])
+            cursor.execute('DELETE FROM video WHERE disparition_id IN (%s)' % placeholders, ids)
+            if housed:
+                cursor.executemany(
+                    'INSERT INTO disparition_tombstone (disparition_id, house_id) VALUES (%s, %s)', housed
+                )
+            released = on_delete(cursor, rows) if on_delete is not None else None
+            cursor.execute('DELETE FROM disparition WHERE disparition_id IN (%s)' % placeholders, ids)
+            conn.commit()
+
+            if released is not None:
+                released(cursor)
+
+            deleted += len(rows)
+            last_id = ids[-1]
+
+            if len(rows) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+
+        if scope.is_empty():
+            # Videos recorded without a disparition
+            while True:
+                cursor.execute('DELETE FROM video ORDER BY video_id LIMIT %s', (batch_size,))
+                count = cursor.rowcount
+                conn.commit()
+                if count < batch_size:
+                    break
+                if pause:
+                    time.sleep(pause)
+
+            versions.bump(cursor, ['disparition'])
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return deleted
+
+
+def prune_tombstones(conn, before, batch_size=BATCH_SIZE, pause=0.0):
+    """
+    Delete the tombstones recorded before `before`, oldest first, in
+    batches of at most `batch_size`. The highest tombstone_id deleted is
+    kept in api_version (versions.TOMBSTONES_PRUNED) in the same
+    transaction, delta clients whose watermark is behind it are told to
+    resync. Returns the number of tombstones deleted.
+    """
+
+    schema.ensure(conn)
+
+    pruned = 0
+    cursor = conn.cursor()
+
+    try:
+        while True:
+            cursor.execute(
+                'SELECT tombstone_id FROM disparition_tombstone WHERE deleted_at < %s ORDER BY tombstone_id LIMIT %s',
+                (before, batch_size)
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+
+            cursor.execute(
+                'INSERT INTO api_version (scope, version) VALUES (%s, %s) '
+                'ON DUPLICATE KEY UPDATE version = GREATEST(version, VALUES(version))',
+                (versions.TOMBSTONES_PRUNED, ids[-1])
+            )
+            cursor.execute(
+                'DELETE FROM disparition_tombstone WHERE tombstone_id IN (%s)' % ', '.join(['%s'] * len(ids)), ids
+            )
+            conn.commit()
+
+            pruned += len(ids)
+            if len(ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return pruned
+
+
+def parse_date(value):
+    """Parse an ISO date or datetime query parameter, None when absent."""
+
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError('Invalid date: %s' % value)
+
+
+def parse_retention(value):
+    """Parse RETENTION_HOUSE_DAYS, a list of house_id=days pairs separated by commas."""
+
+    overrides = {}
+    for item in value.split(','):
+        if item.strip():
+            house_id, _, days = item.partition('=')
+            overrides[house_id.strip()] = int(days)
+    return overrides
+
+
+class RetentionJob:
+    """
+    Background deletion of the disparitions older than the retention
+    period of their house.
+
+    Every `interval` seconds, houses listed in `overrides` keep their own
+    number of days and every other house keeps `days`, a value of 0
+    keeping everything. The deletion runs through `delete_disparitions`
+    with the same batches and pause as the delete route. Tombstones older
+    than `tombstone_days` are pruned in the same pass, so deletions do not
+    grow disparition_tombstone without limit. A MySQL named lock lets a
+    single worker run a pass at a time.
+    """
+
+    def __init__(self, pool, days=0, overrides=None, interval=3600, batch_size=BATCH_SIZE, pause=0.0,
+                 on_delete=None, tombstone_days=0):
+        self.pool = pool
+        self.days = days
+        self.overrides = dict(overrides or {})
+        self.tombstone_days = tombstone_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.on_delete = on_delete
+
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.deleted = 0
+        self.tombstones_pruned = 0
+        self.last_run = None
+
+    def enabled(self):
+        return bool(self.days or any(self.overrides.values()) or self.tombstone_days)
+
+    def start(self):
+        if self._thread is not None or not self.enabled():
+            return
+
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        """Run one pass unless another worker holds the lock, returns the number deleted."""
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT GET_LOCK(%s, 0)', (RETENTION_LOCK,))
+            locked = cursor.fetchone()[0] == 1
+            if not locked:
+                cursor.close()
+                self.skipped += 1
+                return 0
+
+            try:
+                deleted = 0
+                now = datetime.datetime.now()
+
+                for house_id, days in self.overrides.items():
+                    if days:
+                        scope = Scope(house_id=house_id, until=now - datetime.timedelta(days=days))
+                        deleted += self._delete(conn, scope)
+
+                if self.days:
+                    scope = Scope(until=now - datetime.timedelta(days=self.days), exclude_houses=list(self.overrides))
+                    deleted += self._delete(conn, scope)
+
+                if self.tombstone_days:
+                    self.tombstones_pruned += prune_tombstones(
+                        conn, now - datetime.timedelta(days=self.tombstone_days), self.batch_size, self.pause
+                    )
+            finally:
+                try:
+                    cursor.execute('SELECT RELEASE_LOCK(%s)', (RETENTION_LOCK,))
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+
+        self.runs += 1
+        self.deleted += deleted
+        self.last_run = time.time()
+        return deleted
+
+    def after_fork(self):
+        """Drop the retention thread of the parent process."""
+
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'days': self.days,
+            'overrides': self.overrides,
+            'tombstone_days': self.tombstone_days,
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'deleted': self.deleted,
+            'tombstones_pruned': self.tombstones_pruned,
+            'last_run': self.last_run,
+        }
+
+    def _delete(self, conn, scope):
+        return delete_disparitions(conn, scope, self.batch_size, self.pause, self.on_delete)
+
+    def _run(self):
+        while True:
+            try:
+                deleted = self.run_once()
+                if deleted:
+                    logger.info('Retention deleted %d disparitions', deleted)
+            except Exception as error:
+                self.failures += 1
+                logger.warning('Retention pass failed: %s', error)
+            time.sleep(self.interval)
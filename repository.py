@@ -0,0 +1,409 @@
+# Data-access functions used by the routes of app.py
+# Every function answers an endpoint with a single query and returns the
+# exact JSON shape the endpoint used to build row by row
+
+import functools
+
+import pagination
+from jsonprovider import RowSchema
+
+# The user table is keyed on user_id, which is appended after the columns the
+# endpoint exposes so it can be used as the pagination key
+USERS_SQL = 'SELECT * FROM user'
+USERS_SELECT = 'SELECT u.*, u.user_id FROM user u'
+USERS_ORDER = ('u.user_id',)
+
+HOUSES_SELECT = 'SELECT * FROM house'
+HOUSES_ORDER = ('house_id',)
+
+ROOMS_SELECT = 'SELECT * FROM room'
+ROOMS_ORDER = ('room_id',)
+
+VIDEOS_SELECT = 'SELECT * FROM video'
+VIDEOS_ORDER = ('video_id',)
+
+CAN_CONSULT_FROM = (
+    'FROM can_consult cc '
+    'JOIN user u ON u.user_id = cc.user_id '
+    'JOIN house h ON h.house_id = cc.house_id'
+)
+CAN_CONSULT_SELECT = (
+    'SELECT cc.user_id, u.user_firstname, u.user_lastname, cc.house_id, h.house_name ' + CAN_CONSULT_FROM
+)
+CAN_CONSULT_ORDER = ('cc.user_id', 'cc.house_id')
+CAN_CONSULT_SQL = CAN_CONSULT_SELECT + ' ORDER BY cc.user_id, cc.house_id'
+
+HOUSES_OF_USER_SQL = (
+    'SELECT cc.house_id, h.house_name '
+    'FROM can_consult cc '
+    'JOIN house h ON h.house_id = cc.house_id '
+    'WHERE cc.user_id = %s '
+    'ORDER BY cc.house_id'
+)
+
+ROOMS_OF_HOUSE_SQL = 'SELECT room_id, room_name FROM room WHERE house_id = %s ORDER BY room_id'
+
+CAMERAS_OF_HOUSE_SQL = 'SELECT camera_id, camera_name FROM camera WHERE house_id = %s ORDER BY camera_id'
+
+# A disparition is linked to the first video created for it. The house_id
+# comes last, it is not part of the row shape but routes events by house
+DISPARITIONS_FROM = 'FROM disparition d JOIN room r ON r.room_id = d.room_id'
+DISPARITIONS_CAMERA_JOIN = 'LEFT JOIN camera c ON c.camera_id = d.camera_id'
+DISPARITIONS_VIDEO_JOIN = (
+    'LEFT JOIN video v ON v.video_id = ('
+    'SELECT MIN(video_id) FROM video WHERE disparition_id = d.disparition_id'
+    ')'
+)
+DISPARITIONS_SELECT = (
+    'SELECT d.disparition_id, d.disparition_date, d.disparition_object_stolen, '
+    'd.disparition_image_overview, d.disparition_object, d.camera_id, d.room_id, '
+    'r.room_name, c.camera_name, v.video_id, v.video_date, v.video_length, v.video_link, r.house_id '
+    + DISPARITIONS_FROM + ' ' + DISPARITIONS_CAMERA_JOIN + ' ' + DISPARITIONS_VIDEO_JOIN
+)
+DISPARITIONS_ORDER = ('d.disparition_date', 'd.disparition_id')
+DISPARITIONS_OF_HOUSE_SQL = DISPARITIONS_SELECT + ' WHERE r.house_id = %s ORDER BY d.disparition_id'
+DISPARITIONS_SINCE_SQL = (
+    DISPARITIONS_SELECT + ' WHERE r.house_id = %s AND d.disparition_id > %s ORDER BY d.disparition_id LIMIT %s'
+)
+
+DISPARITIONS_BY_ID_SQL = DISPARITIONS_SELECT + ' WHERE d.disparition_id IN (%s) ORDER BY d.disparition_id'
+LAST_DISPARITION_OF_HOUSE_SQL = (
+    'SELECT COALESCE(MAX(d.disparition_id), 0) ' + DISPARITIONS_FROM + ' WHERE r.house_id = %s'
+)
+
+# House snapshot: the house, then one query per included relation
+HOUSE_SQL = 'SELECT house_id, house_name FROM house WHERE house_id = %s'
+
+# The room_id is appended after the video columns to nest videos in their room
+VIDEOS_OF_HOUSE_SQL = (
+    'SELECT v.*, v.room_id FROM video v JOIN room r ON r.room_id = v.room_id '
+    'WHERE r.house_id = %s ORDER BY v.video_id'
+)
+
+RECENT_DISPARITIONS_SQL = (
+    DISPARITIONS_SELECT + ' WHERE r.house_id = %s ORDER BY d.disparition_date DESC, d.disparition_id DESC LIMIT %s'
+)
+
+SNAPSHOT_INCLUDES = ('rooms', 'cameras', 'videos', 'recent_disparitions')
+SNAPSHOT_LIMIT = 10
+
+# Deleted disparitions are recorded per house so delta clients can drop them
+TOMBSTONES_SINCE_SQL = (
+    'SELECT tombstone_id, disparition_id FROM disparition_tombstone '
+    'WHERE house_id = %s AND tombstone_id > %s ORDER BY tombstone_id LIMIT %s'
+)
+
+
+# Row formatters: JSON key, column index and str for the values sent as
+# their str(), see jsonprovider.RowSchema
+user_row = RowSchema(
+    ('user_email', 0),
+    ('user_firstname', 1),
+    ('user_lastname', 2),
+    ('user_password', 3)
+)
+
+can_consult_row = RowSchema(
+    ('user_id', 0),
+    ('user_firstname', 1),
+    ('user_lastname', 2),
+    ('house_id', 3),
+    ('house_name', 4)
+)
+
+house_row = RowSchema(
+    ('house_id', 0),
+    ('house_name', 1)
+)
+
+room_row = RowSchema(
+    ('room_id', 0),
+    ('room_name', 1)
+)
+
+room_with_house_row = RowSchema(
+    ('room_id', 0),
+    ('room_name', 1),
+    ('house_id', 2)
+)
+
+camera_row = RowSchema(
+    ('camera_id', 0),
+    ('camera_name', 1)
+)
+
+video_row = RowSchema(
+    ('video_id', 0),
+    ('video_name', 1),
+    ('room_id', 2)
+)
+
+# Videos of a room, selected with SELECT * FROM video
+room_video_row = RowSchema(
+    ('video_id', 0),
+    ('video_date', 1, str),
+    ('video_length', 2, str),
+    ('video_object_stolen', 3),
+    ('video_link', 4)
+)
+
+disparition_row = RowSchema(
+    ('disparition_id', 0),
+    ('disparition_date', 1, str),
+    ('disparition_object_stolen', 2),
+    ('disparition_image_overview', 3),
+    ('disparition_object', 4),
+    ('camera_id', 5),
+    ('room_id', 6),
+    ('room_name', 7),
+    ('camera_name', 8),
+    ('video_id', 9),
+    ('video_date', 10, str),
+    ('video_length', 11, str),
+    ('video_link', 12)
+)
+
+
+# Keyset pages: select, sort key columns, row formatter and the function
+# giving the sort key of a row, shared by the sync and async servers
+PAGES = {
+    'users': (USERS_SELECT, USERS_ORDER, user_row, lambda row: (row[-1],)),
+    'houses': (HOUSES_SELECT, HOUSES_ORDER, house_row, lambda row: (row[0],)),
+    'rooms': (ROOMS_SELECT, ROOMS_ORDER, room_with_house_row, lambda row: (row[0],)),
+    'videos': (VIDEOS_SELECT, VIDEOS_ORDER, video_row, lambda row: (row[0],)),
+    'can_consult': (CAN_CONSULT_SELECT, CAN_CONSULT_ORDER, can_consult_row, lambda row: (row[0], row[3])),
+    'disparitions': (DISPARITIONS_SELECT, DISPARITIONS_ORDER, disparition_row, lambda row: (str(row[1]), row[0])),
+}
+
+
+# Sparse fieldsets of the fields= parameter: FROM clause, joins only added
+# when a selected column uses their alias, then the JSON key, column and
+# optional str of every field a list can return
+PROJECTIONS = {
+    'users': ('FROM user u', (), (
+        ('user_email', 'u.user_email'),
+        ('user_firstname', 'u.user_firstname'),
+        ('user_lastname', 'u.user_lastname'),
+        ('user_password', 'u.user_password')
+    )),
+    'houses': ('FROM house', (), (
+        ('house_id', 'house_id'),
+        ('house_name', 'house_name')
+    )),
+    'rooms': ('FROM room', (), (
+        ('room_id', 'room_id'),
+        ('room_name', 'room_name'),
+        ('house_id', 'house_id')
+    )),
+    'can_consult': (CAN_CONSULT_FROM, (), (
+        ('user_id', 'cc.user_id'),
+        ('user_firstname', 'u.user_firstname'),
+        ('user_lastname', 'u.user_lastname'),
+        ('house_id', 'cc.house_id'),
+        ('house_name', 'h.house_name')
+    )),
+    'disparitions': (DISPARITIONS_FROM, (('c', DISPARITIONS_CAMERA_JOIN), ('v', DISPARITIONS_VIDEO_JOIN)), (
+        ('disparition_id', 'd.disparition_id'),
+        ('disparition_date', 'd.disparition_date', str),
+        ('disparition_object_stolen', 'd.disparition_object_stolen'),
+        ('disparition_image_overview', 'd.disparition_image_overview'),
+        ('disparition_object', 'd.disparition_object'),
+        ('camera_id', 'd.camera_id'),
+        ('room_id', 'd.room_id'),
+        ('room_name', 'r.room_name'),
+        ('camera_name', 'c.camera_name'),
+        ('video_id', 'v.video_id'),
+        ('video_date', 'v.video_date', str),
+        ('video_length', 'v.video_length', str),
+        ('video_link', 'v.video_link')
+    )),
+}
+
+
+class InvalidFields(ValueError):
+    """Raised when the fields query parameter names a field the list does not have."""
+
+
+def parse_fields(name, value):
+    """Fields of a fields= parameter in their list order, None for all of them."""
+
+    if not value:
+        return None
+
+    wanted = {field.strip() for field in value.split(',') if field.strip()}
+    known = [column[0] for column in PROJECTIONS[name][2]]
+
+    unknown = wanted.difference(known)
+    if unknown:
+        raise InvalidFields('Unknown fields: ' + ', '.join(sorted(unknown)))
+
+    return tuple(key for key in known if key in wanted) or None
+
+
+@functools.lru_cache(maxsize=256)
+def projection(name, fields=None):
+    """
+    PAGES entry of a list selecting only `fields`. The sort key columns are
+    selected after them, so pages and their cursors work whatever the fields.
+    """
+
+    if fields is None:
+        return PAGES[name]
+
+    from_sql, joins, columns = PROJECTIONS[name]
+    order_by = PAGES[name][1]
+    selected = [column for column in columns if column[0] in fields]
+
+    expressions = [column[1] for column in selected] + list(order_by)
+    aliases = {expression.split('.')[0] for expression in expressions}
+    select = 'SELECT ' + ', '.join(expressions) + ' ' + from_sql + ''.join(
+        ' ' + join for alias, join in joins if alias in aliases
+    )
+
+    formatter = RowSchema(*[(column[0], i) + tuple(column[2:]) for i, column in enumerate(selected)])
+    size = len(selected)
+
+    return select, order_by, formatter, lambda row: tuple(row[size:])
+
+
+def list_query(name, fields, conditions=(), order_by=None):
+    """SQL and row formatter of a whole list selecting only `fields`."""
+
+    select, page_order, formatter, key = projection(name, fields)
+
+    sql = select
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY ' + ', '.join(order_by or page_order)
+
+    return sql, formatter
+
+
+def page_result(name, rows, more, fields=None):
+    """Items of a page and the key of its last row, None on the last page."""
+
+    select, order_by, formatter, key = projection(name, fields)
+    return [formatter(row) for row in rows], key(rows[-1]) if more else None
+
+
+def page(cursor, name, limit, after, conditions=(), params=(), fields=None):
+    select, order_by, formatter, key = projection(name, fields)
+    rows, more = pagination.fetch_page(cursor, select, order_by, limit, after, conditions, params)
+    return page_result(name, rows, more, fields)
+
+
+def page_users(cursor, limit, after, fields=None):
+    return page(cursor, 'users', limit, after, fields=fields)
+
+
+def page_houses(cursor, limit, after, fields=None):
+    return page(cursor, 'houses', limit, after, fields=fields)
+
+
+def page_rooms(cursor, limit, after, fields=None):
+    return page(cursor, 'rooms', limit, after, fields=fields)
+
+
+def page_videos(cursor, limit, after):
+    return page(cursor, 'videos', limit, after)
+
+
+def page_can_consult(cursor, limit, after, fields=None):
+    return page(cursor, 'can_consult', limit, after, fields=fields)
+
+
+def page_disparitions_of_house(cursor, house_id, limit, after, fields=None):
+    return page(
+        cursor, 'disparitions', limit, after, conditions=['r.house_id = %s'], params=[house_id], fields=fields
+    )
+
+
+class InvalidSnapshotArgs(ValueError):
+    """Raised when the include or limit query parameters of a snapshot cannot be used."""
+
+
+def snapshot_args(args):
+    """Relations and number of recent disparitions asked for by a snapshot request."""
+
+    include = args.get('include')
+    if include is None:
+        include = SNAPSHOT_INCLUDES
+    else:
+        include = tuple(name.strip() for name in include.split(',') if name.strip())
+        unknown = [name for name in include if name not in SNAPSHOT_INCLUDES]
+        if unknown:
+            raise InvalidSnapshotArgs('include must be a list of: ' + ', '.join(SNAPSHOT_INCLUDES))
+
+    try:
+        limit = int(args.get('limit', SNAPSHOT_LIMIT))
+    except ValueError:
+        raise InvalidSnapshotArgs('limit must be an integer')
+
+    if limit < 1 or limit > pagination.MAX_LIMIT:
+        raise InvalidSnapshotArgs('limit must be between 1 and %d' % pagination.MAX_LIMIT)
+
+    return include, limit
+
+
+def house_snapshot(cursor, house_id, include, limit):
+    """
+    Document of a house with the relations of `include` nested in it, None
+    when the house does not exist.
+
+    Each relation is one query for the whole house whatever its number of
+    rooms, videos are fetched together and grouped by room, so a snapshot
+    runs at most five queries on the cursor's connection.
+    """
+
+    cursor.execute(HOUSE_SQL, (house_id,))
+    house = cursor.fetchone()
+    if house is None:
+        return None
+
+    snapshot = house_row(house)
+
+    if 'rooms' in include or 'videos' in include:
+        cursor.execute(ROOMS_OF_HOUSE_SQL, (house_id,))
+        rooms = [room_row(row) for row in cursor.fetchall()]
+
+        if 'videos' in include:
+            videos = {room['room_id']: [] for room in rooms}
+            cursor.execute(VIDEOS_OF_HOUSE_SQL, (house_id,))
+            for row in cursor.fetchall():
+                videos.setdefault(row[-1], []).append(room_video_row(row))
+            for room in rooms:
+                room['videos'] = videos[room['room_id']]
+
+        snapshot['rooms'] = rooms
+
+    if 'cameras' in include:
+        cursor.execute(CAMERAS_OF_HOUSE_SQL, (house_id,))
+        snapshot['cameras'] = [camera_row(row) for row in cursor.fetchall()]
+
+    if 'recent_disparitions' in include:
+        cursor.execute(RECENT_DISPARITIONS_SQL, (house_id, limit))
+        snapshot['recent_disparitions'] = [disparition_row(row) for row in cursor.fetchall()]
+
+    return snapshot
+
+
+# Delta sync: rows created and disparitions deleted after a watermark. Each
+# function returns the rows of the batch, the new watermark part and whether
+# more rows are waiting. Watermarks are ids of one house, which its writers
+# allocate in commit order (see versions.py): no id below a watermark can
+# still be committed later
+
+def disparitions_since(cursor, house_id, after_id, limit):
+    cursor.execute(DISPARITIONS_SINCE_SQL, (house_id, after_id, limit + 1))
+    rows = cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return [disparition_row(row) for row in rows], rows[-1][0] if rows else after_id, more
+
+
+def tombstones_since(cursor, house_id, after_id, limit):
+    cursor.execute(TOMBSTONES_SINCE_SQL, (house_id, after_id, limit + 1))
+    rows = cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return [row[1] for row in rows], rows[-1][0] if rows else after_id, more
@@ -0,0 +1,132 @@
+import schema
+
+# Daily counts of disparition by house, room, object and stolen flag, kept in
+# disparition_rollup by the writers (see schema.py). A NULL object is stored
+# as '' since it is part of the primary key
+ROLLUP_SELECT = (
+    'SELECT r.house_id, DATE(d.disparition_date), d.room_id, COALESCE(d.disparition_object, \'\'), '
+    'COALESCE(d.disparition_object_stolen, 0) <> 0, %s COUNT(*) '
+    'FROM disparition d JOIN room r ON r.room_id = d.room_id '
+)
+ROLLUP_GROUP = (
+    ' GROUP BY r.house_id, DATE(d.disparition_date), d.room_id, COALESCE(d.disparition_object, \'\'), '
+    'COALESCE(d.disparition_object_stolen, 0) <> 0'
+)
+
+ROLLUP_UPSERT = (
+    'INSERT INTO disparition_rollup (house_id, day, room_id, disparition_object, stolen, disparition_count) '
+    '%s ON DUPLICATE KEY UPDATE disparition_count = disparition_count + VALUES(disparition_count)'
+)
+
+# Start of the bucket a day falls in
+BUCKETS = {
+    'day': 'ru.day',
+    'week': 'DATE_SUB(ru.day, INTERVAL WEEKDAY(ru.day) DAY)',
+    'month': 'DATE_SUB(ru.day, INTERVAL DAYOFMONTH(ru.day) - 1 DAY)',
+    'year': 'MAKEDATE(YEAR(ru.day), 1)',
+    'all': 'NULL',
+}
+
+# JSON keys and columns of each grouping
+GROUPS = {
+    'none': [],
+    'room': [('room_id', 'ru.room_id'), ('room_name', 'rm.room_name')],
+    'object': [('disparition_object', "NULLIF(ru.disparition_object, '')")],
+    'stolen': [('disparition_object_stolen', 'ru.stolen')],
+}
+
+
+class InvalidStatisticsArgs(ValueError):
+    """Raised when the bucket or group_by query parameters are not supported."""
+
+
+def _by_ids(disparition_ids, sign):
+    placeholders = ', '.join(['%s'] * len(disparition_ids))
+    return ROLLUP_UPSERT % (
+        ROLLUP_SELECT % sign + 'WHERE d.disparition_id IN (%s)' % placeholders + ROLLUP_GROUP
+    )
+
+
+def add(cursor, disparition_ids):
+    """Count disparitions just inserted, in the inserting transaction."""
+
+    if disparition_ids:
+        cursor.execute(_by_ids(disparition_ids, ''), list(disparition_ids))
+
+
+def remove(cursor, disparition_ids, house_ids):
+    """Uncount disparitions of `house_ids` about to be deleted, in the deleting transaction."""
+
+    if not disparition_ids:
+        return
+
+    cursor.execute(_by_ids(disparition_ids, '-'), list(disparition_ids))
+    if not house_ids:
+        return
+    cursor.execute(
+        'DELETE FROM disparition_rollup WHERE house_id IN (%s) AND disparition_count <= 0'
+        % ', '.join(['%s'] * len(house_ids)),
+        list(house_ids)
+    )
+
+
+def on_delete(cursor, rows):
+    """purge.delete_disparitions hook, `rows` are (disparition_id, house_id) pairs."""
+
+    remove(cursor, [row[0] for row in rows], sorted({row[1] for row in rows if row[1] is not None}))
+
+
+def rebuild(conn):
+    """Recount every disparition, for data written before the rollups existed."""
+
+    schema.ensure(conn)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('DELETE FROM disparition_rollup')
+        cursor.execute(ROLLUP_UPSERT % (ROLLUP_SELECT % '' + ROLLUP_GROUP))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def statistics_query(house_id, bucket='day', group_by='none', since=None, until=None):
+    """SQL and parameters of the counts of a house per bucket and group."""
+
+    if bucket not in BUCKETS:
+        raise InvalidStatisticsArgs('bucket must be one of: ' + ', '.join(BUCKETS))
+    if group_by not in GROUPS:
+        raise InvalidStatisticsArgs('group_by must be one of: ' + ', '.join(GROUPS))
+
+    columns = [BUCKETS[bucket]] + [column for key, column in GROUPS[group_by]]
+    conditions = ['ru.house_id = %s']
+    params = [house_id]
+
+    if since is not None:
+        conditions.append('ru.day >= %s')
+        params.append(since)
+    if until is not None:
+        conditions.append('ru.day < %s')
+        params.append(until)
+
+    positions = ', '.join(str(i + 1) for i in range(len(columns)))
+    sql = (
+        'SELECT ' + ', '.join(columns) + ', SUM(ru.disparition_count) '
+        'FROM disparition_rollup ru '
+        + ('LEFT JOIN room rm ON rm.room_id = ru.room_id ' if group_by == 'room' else '')
+        + 'WHERE ' + ' AND '.join(conditions)
+        + ' GROUP BY ' + positions + ' ORDER BY ' + positions
+    )
+
+    return sql, params
+
+
+def statistics_row(group_by, row):
+    item = {'bucket': str(row[0]) if row[0] is not None else None}
+    for i, (key, column) in enumerate(GROUPS[group_by]):
+        item[key] = row[i + 1]
+    item['count'] = int(row[-1])
+    return item
@@ -0,0 +1,111 @@
+import logging
+import threading
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+# Tables maintained by the API next to the application schema, created on first use
+TABLES = [
+    'CREATE TABLE IF NOT EXISTS api_version ('
+    'scope VARCHAR(64) NOT NULL PRIMARY KEY, '
+    'version BIGINT UNSIGNED NOT NULL DEFAULT 0'
+    ')',
+    'CREATE TABLE IF NOT EXISTS disparition_tombstone ('
+    'tombstone_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+    'disparition_id INT NOT NULL, '
+    'house_id INT NOT NULL, '
+    'deleted_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+    'KEY house_tombstone (house_id, tombstone_id)'
+    ')',
+    'CREATE TABLE IF NOT EXISTS disparition_rollup ('
+    'house_id INT NOT NULL, '
+    'day DATE NOT NULL, '
+    'room_id INT NOT NULL, '
+    "disparition_object VARCHAR(255) NOT NULL DEFAULT '', "
+    'stolen TINYINT(1) NOT NULL, '
+    'disparition_count INT NOT NULL, '
+    'PRIMARY KEY (house_id, day, room_id, disparition_object, stolen)'
+    ')',
+]
+
+# Tables written outside the API. A trigger per table and event bumps the
+# api_version scope named after the table, which is what invalidates the
+# ETags and the permission index depending on them
+TRACKED_TABLES = ('house', 'room', 'camera', 'can_consult', 'user')
+
+TRIGGERS = {
+    'api_version_%s_%s' % (table, suffix): (
+        'CREATE TRIGGER api_version_%s_%s AFTER %s ON %s FOR EACH ROW '
+        "INSERT INTO api_version (scope, version) VALUES ('%s', 1) "
+        'ON DUPLICATE KEY UPDATE version = version + 1' % (table, suffix, event, table, table)
+    )
+    for table in TRACKED_TABLES
+    for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE'))
+}
+
+EXISTING_TRIGGERS_SQL = 'SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = DATABASE()'
+
+_ready = False
+_tracked = False
+_lock = threading.Lock()
+
+
+def ready():
+    return _ready
+
+
+def tracked(scopes):
+    """Whether every one of `scopes` is bumped when its rows change."""
+
+    return _tracked or not any(scope in TRACKED_TABLES for scope in scopes)
+
+
+def set_tracked(value):
+    global _tracked
+    _tracked = value
+
+
+def missing_triggers(existing):
+    """CREATE TRIGGER statements of the triggers not in `existing`, a set of names."""
+
+    return [statement for name, statement in sorted(TRIGGERS.items()) if name not in existing]
+
+
+def ensure(conn):
+    """
+    Create the API tables once per process.
+
+    DDL commits implicitly in MySQL, so this must run before a write
+    transaction is opened on `conn`, never in the middle of one.
+    """
+
+    global _ready
+    if _ready:
+        return
+
+    with _lock:
+        if _ready:
+            return
+
+        cursor = conn.cursor()
+        for statement in TABLES:
+            cursor.execute(statement)
+
+        # Creating triggers takes the TRIGGER privilege, without it the
+        # tracked scopes are never bumped and their routes are not versioned
+        try:
+            cursor.execute(EXISTING_TRIGGERS_SQL)
+            for statement in missing_triggers({row[0] for row in cursor.fetchall()}):
+                cursor.execute(statement)
+            set_tracked(True)
+        except mysql.connector.Error as error:
+            logger.warning(
+                'Version triggers unavailable, house, room and camera responses are not versioned and '
+                'the permission index only expires with its TTL: %s', error
+            )
+
+        cursor.close()
+        conn.commit()
+
+        _ready = True
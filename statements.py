@@ -0,0 +1,85 @@
+import threading
+import weakref
+
+import mysql.connector
+
+import repository
+
+# Hot parameterised lookups, run by name through server-side prepared statements
+STATEMENTS = {
+    'house_name': 'SELECT house_name FROM house WHERE house_id = %s',
+    'room_name': 'SELECT room_name FROM room WHERE room_id = %s',
+    'camera_name': 'SELECT camera_name FROM camera WHERE camera_id = %s',
+    'houses_of_user': repository.HOUSES_OF_USER_SQL,
+    'rooms_of_house': repository.ROOMS_OF_HOUSE_SQL,
+    'cameras_of_house': repository.CAMERAS_OF_HOUSE_SQL,
+    'videos_of_room': 'SELECT * FROM video WHERE room_id = %s',
+}
+
+# Prepared cursors of each pooled connection, dropped with the connection
+_cursors = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+_stats = {
+    'prepares': 0,
+    'executions': 0,
+    'reprepares': 0,
+}
+
+
+def run(conn, name, params):
+    """
+    Execute the statement registered under `name` and return all its rows.
+
+    The statement is prepared once per connection. A prepared cursor whose
+    statement handle was lost, for instance after the session was reset,
+    is prepared again and the call retried once.
+    """
+
+    try:
+        return _execute(conn, name, params)
+    except mysql.connector.Error:
+        if not conn.is_connected():
+            raise
+        _forget(conn, name)
+        with _lock:
+            _stats['reprepares'] += 1
+        return _execute(conn, name, params)
+
+
+def after_fork():
+    """Forget the prepared cursors of the connections inherited from the parent process."""
+
+    global _cursors, _lock
+    _cursors = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+
+
+def stats():
+    with _lock:
+        return dict(_stats, connections=len(_cursors))
+
+
+def _execute(conn, name, params):
+    with _lock:
+        cursors = _cursors.setdefault(conn, {})
+        cursor = cursors.get(name)
+        if cursor is None:
+            cursor = conn.cursor(prepared=True)
+            cursors[name] = cursor
+            _stats['prepares'] += 1
+        _stats['executions'] += 1
+
+    cursor.execute(STATEMENTS[name], params)
+    return cursor.fetchall()
+
+
+def _forget(conn, name):
+    with _lock:
+        cursor = _cursors.get(conn, {}).pop(name, None)
+
+    if cursor is not None:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            pass
@@ -0,0 +1,43 @@
+import os
+
+import mysql.connector
+from flask import Response, current_app, stream_with_context
+
+BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+
+
+def stream_json_array(conn, sql, params, formatter, batch_size=BATCH_SIZE):
+    """
+    Stream the rows of a query as a JSON array.
+
+    Rows are read from an unbuffered cursor in fetchmany batches and encoded
+    one by one with the app's JSON provider, so the output is byte for byte
+    what jsonify returns for the same list outside debug mode.
+    """
+
+    cursor = conn.cursor(buffered=False)
+    # Run the query before the response starts so SQL errors still become a 500
+    cursor.execute(sql, params)
+
+    dumps = current_app.json.dumps
+
+    def generate():
+        try:
+            separator = '['
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield separator + ','.join(dumps(formatter(row), separators=(',', ':')) for row in rows)
+                separator = ','
+
+            yield ']\n' if separator == ',' else '[]\n'
+        finally:
+            # A client that disconnects early leaves unread rows behind, the
+            # pool then discards the connection instead of reusing it
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+
+    return Response(stream_with_context(generate()), mimetype=current_app.json.mimetype)
@@ -0,0 +1,87 @@
+import hashlib
+
+import schema
+
+# Version scopes:
+#   house, room, camera          - dimension tables, bumped by triggers (see schema.py)
+#   can_consult, user            - rows of the permission index, bumped by triggers
+#   disparition                  - every house at once (delete_disparitions)
+#   disparition:<house_id>       - disparitions of one house
+#   tombstones_pruned            - not a counter, the highest tombstone_id
+#                                  deleted by purge.prune_tombstones
+#
+# Writers of disparitions and tombstones bump disparition:<house_id> before
+# inserting. The row lock it takes is held until the commit, so the ids of
+# one house are allocated in commit order and a reader that saw id N has
+# seen every committed id of the house below N (see repository.py)
+
+
+def read_sql(scopes):
+    return 'SELECT scope, version FROM api_version WHERE scope IN (%s)' % ', '.join(['%s'] * len(scopes))
+
+
+def read(conn, scopes):
+    """
+    Return the version of each scope, 0 for a scope that was never bumped,
+    or None when one of them is not maintained and cannot tell a change.
+    """
+
+    schema.ensure(conn)
+    if not schema.tracked(scopes):
+        return None
+
+    cursor = conn.cursor()
+    cursor.execute(read_sql(scopes), list(scopes))
+    found = dict(cursor.fetchall())
+    cursor.close()
+
+    return [found.get(scope, 0) for scope in scopes]
+
+
+def make_etag(numbers, scopes, path):
+    """
+    Strong ETag of the representation at `path` (path and query string) at
+    the versions `numbers` of `scopes`. Scopes and path are hashed with
+    BLAKE2b, a client cannot craft another URL sharing the ETag.
+    """
+
+    digest = hashlib.blake2b('\0'.join(list(scopes) + [path]).encode(), digest_size=16).hexdigest()
+    return 'v%s-%s' % ('.'.join(str(version) for version in numbers), digest)
+
+
+def cache_key(numbers, scopes, path):
+    """Key of the compressed bodies of a versioned representation, see compression.Compressor."""
+
+    return path, tuple(scopes), tuple(numbers)
+
+
+TOMBSTONES_PRUNED = 'tombstones_pruned'
+
+
+def pruned_tombstone(cursor):
+    """Highest tombstone_id pruned so far, 0 when none was."""
+
+    cursor.execute('SELECT version FROM api_version WHERE scope = %s', (TOMBSTONES_PRUNED,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump(cursor, scopes):
+    # Always lock the rows in the same order so concurrent writers cannot deadlock
+    scopes = sorted(set(scopes))
+    cursor.execute(
+        'INSERT INTO api_version (scope, version) VALUES %s '
+        'ON DUPLICATE KEY UPDATE version = version + 1' % ', '.join(['(%s, 1)'] * len(scopes)),
+        list(scopes)
+    )
+
+
+def bump_houses_of_rooms(cursor, room_ids):
+    """Bump disparition:<house_id> of every house owning one of `room_ids`."""
+
+    cursor.execute(
+        "INSERT INTO api_version (scope, version) "
+        "SELECT DISTINCT CONCAT('disparition:', house_id), 1 FROM room WHERE room_id IN (%s) ORDER BY 1 "
+        "ON DUPLICATE KEY UPDATE version = version + 1" % ', '.join(['%s'] * len(room_ids)),
+        list(room_ids)
+    )
@@ -0,0 +1,174 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import ingest
+from cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a record is submitted while the queue is at capacity."""
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of disparition records written by a background
+    thread.
+
+    The flusher writes a batch as soon as `batch_size` records are waiting or
+    `interval` seconds after the first one arrived, through
+    `ingest.insert_disparitions`. A batch that fails is retried record by
+    record so one bad payload does not take the others down with it.
+    `on_insert(conn, disparition_ids)` is called after each committed batch.
+    Tracking statuses are kept by the worker that accepted the record.
+    """
+
+    def __init__(self, pool, maxsize=1000, batch_size=100, interval=1.0, status_size=10000, status_ttl=3600,
+                 on_insert=None):
+        self.pool = pool
+        self.on_insert = on_insert
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._queue = queue.Queue(maxsize)
+        self._statuses = LRUCache(status_size, status_ttl)
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def submit(self, record):
+        if self._stop.is_set():
+            raise QueueFull('Ingestion queue is shutting down')
+
+        self._ensure_started()
+
+        tracking_id = uuid.uuid4().hex
+        # Recorded before queueing so the flusher cannot be overwritten by it
+        self._statuses.set(tracking_id, {'state': 'queued'})
+
+        try:
+            self._queue.put_nowait((tracking_id, record))
+        except queue.Full:
+            self._statuses.invalidate(tracking_id)
+            self.rejected += 1
+            raise QueueFull('Ingestion queue is full')
+
+        self.accepted += 1
+        return tracking_id
+
+    def status(self, tracking_id):
+        status = self._statuses.get(tracking_id)
+        if status is MISSING:
+            return None
+        return dict(status, tracking_id=tracking_id)
+
+    def stop(self, timeout=30):
+        """Stop accepting work and flush what is still queued."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'queued': self._queue.qsize(),
+            'maxsize': self._queue.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+    def after_fork(self):
+        """Start over with an empty queue, records accepted by the parent process are its own."""
+
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    # The thread is started on first use so it is created in the worker
+    # process, never in a parent that forks afterwards
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                # Draining on stop: full batches of what is queued, no waiting
+                if self._stop.is_set():
+                    batch.append(self._queue.get_nowait())
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _flush(self, batch):
+        try:
+            with self.pool.connection() as conn:
+                ids = ingest.insert_disparitions(conn, [record for tracking_id, record in batch])
+        except Exception as error:
+            if len(batch) > 1:
+                for item in batch:
+                    self._flush([item])
+                return
+
+            logger.warning('Write-behind insert failed: %s', error)
+            self.failed += 1
+            self._statuses.set(batch[0][0], {'state': 'failed', 'error': str(error)})
+            return
+
+        self.batches += 1
+        self.written += len(batch)
+        for (tracking_id, record), (disparition_id, video_id) in zip(batch, ids):
+            self._statuses.set(tracking_id, {
+                'state': 'created',
+                'disparition_id': disparition_id,
+                'video_id': video_id
+            })
+
+        # The batch is committed, a failed publish must not insert it again
+        if self.on_insert is not None:
+            try:
+                with self.pool.connection() as conn:
+                    self.on_insert(conn, [disparition_id for disparition_id, video_id in ids])
+            except Exception as error:
+                logger.warning('Publishing written disparitions failed: %s', error)